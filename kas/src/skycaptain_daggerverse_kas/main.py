@@ -2,7 +2,14 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 #
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import time
 from datetime import datetime
+from pathlib import Path
 from typing import Annotated, Self
 
 import dagger
@@ -13,22 +20,138 @@ DEFAULT_BASE_IMAGE_REF = "ghcr.io/siemens/kas/kas:4.8"
 KAS_WORK_DIR = "/workdir"
 KAS_REPO_REF_DIR = "/repos"
 KAS_BUILD_DIR = "/build"
+# Work directories and task stamps of the default TMPDIR. The work directories make up the bulk
+# of a build's disk footprint
+BUILD_WORK_DIR = f"{KAS_BUILD_DIR}/tmp/work"
+BUILD_STAMPS_DIR = f"{KAS_BUILD_DIR}/tmp/stamps"
 
 DL_DIR = "/downloads"
 SSTATE_DIR = "/sstate-cache"
+MIRROR_DIR = "/mirror"
+HASHSERV_DIR = "/hashserv"
+PRSERV_DIR = "/prserv"
 
 CACHE_CACHE_KEY = "cache-cache"
 DOWNLOADS_CACHE_KEY = "downloads-cache"
 SSTATE_CACHE_KEY = "sstate-cache"
 REPO_REF_CACHE_KEY = "repo-ref-cache"
+HASHSERV_CACHE_KEY = "hashserv-cache"
+PRSERV_CACHE_KEY = "prserv-cache"
+
+HASHSERV_ALIAS = "hashserv"
+HASHSERV_PORT = 8686
+PRSERV_ALIAS = "prserv"
+PRSERV_PORT = 8585
+SSTATE_MIRROR_ALIAS = "sstate-mirror"
+SSTATE_MIRROR_PORT = 8080
 
 DUMP_STDOUT_FILEPATH = "/tmp/.daggerverse-kas-dump-stdout"
 LOCK_STDOUT_FILEPATH = "/tmp/.daggerverse-kas-lock-stdout"
+BUILD_STDOUT_FILEPATH = "/tmp/.daggerverse-kas-build-stdout"
+PRSERV_LOG_FILEPATH = "/tmp/.daggerverse-kas-prserv.log"
+MIRROR_EXPORT_DIR = "/tmp/.daggerverse-kas-mirror"
+BUILD_REPORT_FILEPATH = "/tmp/.daggerverse-kas-build-report.json"
+SCRIPTS_MOUNT_DIR = "/tmp/.daggerverse-kas-scripts"
+SHELL_SESSION_COMMANDS_FILEPATH = "/tmp/.daggerverse-kas-shell-session-commands.json"
+SHELL_SESSION_RESULTS_FILEPATH = "/tmp/.daggerverse-kas-shell-session-results.json"
+FOR_ALL_REPOS_REPOS_FILEPATH = "/tmp/.daggerverse-kas-for-all-repos-repos.jsonl"
+FOR_ALL_REPOS_RESULTS_FILEPATH = "/tmp/.daggerverse-kas-for-all-repos-results.json"
+CONFIG_FILEPATH = "/tmp/.daggerverse-kas-config"
+CONFIG_JSON_FILEPATH = "/tmp/.daggerverse-kas-config.json"
+FAILED_TASK_LOGS_DIR = "/tmp/.daggerverse-kas-failed-task-logs"
+SSTATE_PUSH_MARKER_FILEPATH = "/tmp/.daggerverse-kas-sstate-push-marker"
+DEPLOY_IMAGES_DIR = "/tmp/.daggerverse-kas-deploy-images"
+ROOTFS_DIR = "/tmp/.daggerverse-kas-rootfs"
+
+# Written next to the first configuration file, as kas requires all concatenated configuration
+# files to belong to the same repository
+OVERLAY_FILENAME = ".daggerverse-kas-overlay.yml"
+# Kas sorts the local_conf_header entries by name, thus apply this module's settings last
+OVERLAY_LOCAL_CONF_HEADER = "zz-daggerverse-kas"
+
+# Helper scripts executed inside the kas container
+SCRIPTS_DIR = Path(__file__).parent / "scripts"
 
 GITCONFIG_FILE = "/tmp/.daggerverse-kas-gitconfig"
-
+GITCONFIG_CONTENTS = "[safe]\n\tdirectory = *\n"
+
+CACHE_BUSTER_ENV_VARIABLE = "DAGGERVERSE_KAS_CACHE_BUSTER"
+RESOLVED_REFS_ENV_VARIABLE = "DAGGERVERSE_KAS_RESOLVED_REFS"
+
+# Cache volumes mounted by with_prepare and their mount points
+CACHE_VOLUMES = {
+    REPO_REF_CACHE_KEY: KAS_REPO_REF_DIR,
+    CACHE_CACHE_KEY: f"{KAS_BUILD_DIR}/cache",
+    DOWNLOADS_CACHE_KEY: DL_DIR,
+    SSTATE_CACHE_KEY: SSTATE_DIR,
+}
+
+# Layout of mirror directories, relative to their root
+MIRROR_DOWNLOADS_DIR = "downloads"
+MIRROR_SSTATE_DIR = "sstate-cache"
+
+# Fetcher schemes redirected to the downloads mirror
+MIRROR_SCHEMES = ["bzr", "cvs", "ftp", "git", "gitsm", "hg", "http", "https", "npm", "p4", "svn"]
+
+# Memory assumed to be needed per bitbake thread when deriving thread counts from engine resources
+MEMORY_PER_THREAD = 2 << 30
+
+# Prints the number of usable CPUs, the total memory in kB and the cgroup memory limit in bytes
+ENGINE_RESOURCES_SCRIPT = """
+nproc
+awk '/^MemTotal:/ { print $2 }' /proc/meminfo
+cat /sys/fs/cgroup/memory.max 2>/dev/null || echo max
+"""
+
+# Prints the environment kas for-all-repos provides for a repository as a JSON line
+REPO_ENV_COMMAND = (
+    "python3 -c 'import json, os; print(json.dumps("
+    '{k: v for k, v in os.environ.items() if k.startswith("KAS_REPO_")}))\''
+)
+
+# Copies the objects a repository borrows from the repo ref cache into the repository itself
+DISSOCIATE_REPO_COMMAND = (
+    "if [ -f .git/objects/info/alternates ]; then"
+    " git repack -a -d -q && rm .git/objects/info/alternates; fi"
+)
+
+# Converts a YAML (or JSON) file to JSON, using the PyYAML that ships with kas
+YAML_TO_JSON_SCRIPT = (
+    "import json, sys, yaml; json.dump(yaml.safe_load(open(sys.argv[1])), sys.stdout)"
+)
+
+# Defaults kas applies when the configuration doesn't set these
+KAS_DEFAULT_MACHINE = "qemux86-64"
+KAS_DEFAULT_DISTRO = "poky"
+KAS_DEFAULT_TARGET = "core-image-minimal"
+
+# Values of a layer entry that exclude the layer
+DISABLED_LAYER_VALUES = ["disabled", "excluded", "n", "no", "0", "false"]
+
+# Relative to the source directory. Excludes content that doesn't affect the build, so that it
+# doesn't invalidate the layer cache of all subsequent steps
+DEFAULT_SOURCE_EXCLUDE = [".git", ".github", ".gitlab-ci.yml", ".idea", ".vscode", "build"]
+
+# Compressions of the tar image types (IMAGE_FSTYPES) that GNU tar detects on extraction
+ROOTFS_TARBALL_SUFFIXES = [".tar", ".tar.bz2", ".tar.gz", ".tar.xz", ".tar.zst"]
+
+# Relative to the build directory. Matches both TMPDIR defaults of poky (tmp) and OE (tmp-glibc)
+DEFAULT_ARTIFACTS_INCLUDE = ["tmp*/deploy/**"]
+
+AcceptUploadsDoc = Doc("Accept uploads of sstate objects")
+ArtifactsExcludeDoc = Doc("Patterns to exclude from the artifacts, relative to the build directory")
+ArtifactsIncludeDoc = Doc("Patterns to include in the artifacts, relative to the build directory")
+BbNumberThreadsDoc = Doc("Number of bitbake tasks to run in parallel (BB_NUMBER_THREADS)")
+BuildstatsDoc = Doc("Record per-task build statistics for a build report")
+CacheScopeDoc = Doc("Scope of the parse cache, e.g. a release branch (defaults to the base image)")
 CommandDoc = Doc("Command to run")
+CommandsDoc = Doc("Commands to run in a single session")
 ConfigDoc = Doc("Configuration file(s)")
+ConfigSetDoc = Doc("Colon-separated configuration file(s) for each matrix entry")
+ConsoleTailDoc = Doc("Include up to this many bytes from the end of the console log")
+EngineShareDoc = Doc(
+    "Derive thread counts from the engine's CPUs and memory, split across this many builds"
+)
 ExpandDoc = Doc("Expand environment variables in arguments")
 ExpectDoc = Doc("Expected return type")
 ExtraArgsDoc = Doc("Additional command arguments")
@@ -36,16 +159,55 @@ ExtraBitbakeArgsDoc = Doc("Extra arguments to pass to bitbake")
 ExtraEnvVariablesDoc = Doc("Additional environment variables (KEY=VALUE format)")
 ForceCheckoutDoc = Doc("Always checkout desired commit/branch/tag, discarding local changes")
 FormatDoc = Doc("Output format (yaml or json)")
+GenerateMirrorTarballsDoc = Doc("Generate tarballs of git sources for use in a mirror")
+HashEquivalenceDoc = Doc("Start a local hash equivalence server from the configuration")
+HashservConfigDoc = Doc("Configuration file(s) to start a local hash equivalence server from")
+HashservDoc = Doc("Hash equivalence server (bitbake-hashserv) to bind to the build")
+ImageDoc = Doc("Image recipe, e.g. core-image-minimal")
+InvalidateConfigDoc = Doc("Invalidate when the refs of the configuration's repositories move")
+InvalidateKeyDoc = Doc("Invalidate when this key changes")
+InvalidateLockFileDoc = Doc("Invalidate when this lock file changes")
+InvalidateTtlDoc = Doc("Invalidate at least every this many seconds")
+JobsDoc = Doc("Maximum number of repositories to process concurrently")
 KeepConfigUnchangedDoc = Doc("Skip steps that change the configuration")
+KeyOnRefsDoc = Doc("Resolve floating refs first and only re-run the checkout when they moved")
+LocalConfDoc = Doc("Lines added to the local.conf of builds by with_prepare")
 LockDoc = Doc("Create lockfile with exact SHAs")
+MachineDoc = Doc("Machine the image was built for")
+MachinesDoc = Doc("Machines to build each configuration set for (overrides MACHINE)")
+MaxAgeDoc = Doc("Evict entries not used for longer than this many seconds")
+MaxSizeDoc = Doc("Evict least recently used entries until the cache fits this many bytes")
+MirrorDoc = Doc("Mirror directory with downloads and sstate-cache subdirectories")
 NetrcDoc = Doc("Netrc file for authentication")
+NonRootUserDoc = Doc("Non-root user of the container (queried from the container if unset)")
+ParallelMakeDoc = Doc("Number of make jobs per task (PARALLEL_MAKE)")
+PlatformDoc = Doc("Platform of the container (defaults to the engine's platform)")
+PrServiceDoc = Doc("Start a local PR server from the configuration")
 PreserveEnvDoc = Doc("Keep current user environment block")
+PressureMaxCpuDoc = Doc("Maximum CPU pressure before new tasks are held back")
+PressureMaxIoDoc = Doc("Maximum IO pressure before new tasks are held back")
+PressureMaxMemoryDoc = Doc("Maximum memory pressure before new tasks are held back")
+PrservConfigDoc = Doc("Configuration file(s) to start a local PR server from")
+PrservDoc = Doc("PR server (bitbake-prserv) to bind to the build")
+PruneOrderDoc = Doc("Timestamp defining recent use (atime or mtime)")
 ResolveEnvDoc = Doc("Set environment defaults to captured environment values")
 ResolveLocalDoc = Doc("Add tracking information of root repository")
 ResolveRefsDoc = Doc("Replace floating refs with exact SHAs")
+RmWorkDoc = Doc("Remove the work directory of each recipe once it is built (rm_work)")
+RmWorkExcludeDoc = Doc("Recipes to keep the work directory of (RM_WORK_EXCLUDE)")
+ScopeSstateDoc = Doc("Scope the sstate cache as well instead of sharing it across scopes")
+ServerTimeoutDoc = Doc("Seconds to keep the bitbake server alive between commands")
+SharedCachesDoc = Doc("Share the parse and repo ref caches between concurrent builds")
+SplitResourcesDoc = Doc("Split the engine's CPUs and memory evenly across the matrix entries")
 SrcDoc = Doc("Source directory")
+SrcExcludeDoc = Doc("Patterns to exclude from the source directory")
+SrcIncludeDoc = Doc("Patterns to include from the source directory")
+SstateMirrorDoc = Doc("HTTP sstate mirror service (see sstate_mirror_service) to bind to the build")
+SstateMirrorUploadDoc = Doc("Upload the sstate objects of each build to the mirror")
 TargetDoc = Doc("Target to build")
+TargetsDoc = Doc("Targets to build in a single bitbake run, optionally as target:task pairs")
 TaskDoc = Doc("Task to run")
+TmpfsSizeDoc = Doc("Keep the work directories on a tmpfs of this many bytes instead of on disk")
 UpdateDoc = Doc("Pull upstream changes to the branch even if already checked out")
 
 
@@ -53,6 +215,42 @@ def format_config_arg(configs: list[str]) -> str:
     return ":".join(configs)
 
 
+def script_file(name: str) -> dagger.File:
+    return dag.file(name, (SCRIPTS_DIR / name).read_text(), permissions=0o755)
+
+
+def parse_repos(config: dict) -> list["KasRepo"]:
+    repos = []
+
+    # Lock files only pin commits through overrides
+    configured = config.get("repos") or {}
+    overrides = (config.get("overrides") or {}).get("repos") or {}
+
+    for name in {**configured, **overrides}:
+        repo = {**(configured.get(name) or {}), **(overrides.get(name) or {})}
+
+        # Without layers, the repository itself is the layer
+        layers = repo.get("layers") or ({".": None} if name in configured else {})
+
+        repos.append(
+            KasRepo(
+                name=name,
+                url=repo.get("url"),
+                commit=repo.get("commit"),
+                branch=repo.get("branch"),
+                tag=repo.get("tag"),
+                path=repo.get("path"),
+                layers=[
+                    layer
+                    for layer, value in layers.items()
+                    if str(value).lower() not in DISABLED_LAYER_VALUES
+                ],
+            )  # type: ignore
+        )
+
+    return repos
+
+
 @object_type
 class Kas:
     base_image_ref: Annotated[str, Doc("Base container image reference")] = DEFAULT_BASE_IMAGE_REF
@@ -61,6 +259,16 @@ class Kas:
     src: Annotated[dagger.Directory, SrcDoc] = field(default=dag.directory)
 
     netrc: Annotated[dagger.Secret | None, NetrcDoc] = None
+    hashserv: Annotated[dagger.Service | None, HashservDoc] = None
+    prserv: Annotated[dagger.Service | None, PrservDoc] = None
+    mirror: Annotated[dagger.Directory | None, MirrorDoc] = None
+    cache_scope: Annotated[str | None, CacheScopeDoc] = None
+    scope_sstate: Annotated[bool, ScopeSstateDoc] = False
+    shared_caches: Annotated[bool, SharedCachesDoc] = False
+    sstate_mirror: Annotated[dagger.Service | None, SstateMirrorDoc] = None
+    sstate_mirror_upload: Annotated[bool, SstateMirrorUploadDoc] = False
+    local_conf: Annotated[list[str], LocalConfDoc] = field(default=list, init=False)
+    non_root_user: Annotated[str | None, NonRootUserDoc] = None
 
     def __post_init__(self):
         self.ctr = self._base()
@@ -81,8 +289,20 @@ class Kas:
         return self.container().directory(KAS_WORK_DIR)
 
     @function
-    def with_source(self, path: Annotated[dagger.Directory, SrcDoc]) -> Self:
-        self.src = path
+    def with_source(
+        self,
+        path: Annotated[dagger.Directory, SrcDoc],
+        include: Annotated[list[str] | None, SrcIncludeDoc] = None,
+        exclude: Annotated[list[str] | None, SrcExcludeDoc] = None,
+    ) -> Self:
+        # Copy only the relevant content, so that the digest of the source directory (and thus the
+        # cache key of all subsequent steps) only changes with the configuration and layers
+        self.src = dag.directory().with_directory(
+            ".",
+            path,
+            include=include,
+            exclude=DEFAULT_SOURCE_EXCLUDE if exclude is None else exclude,
+        )
         return self
 
     @function
@@ -90,22 +310,95 @@ class Kas:
         self.netrc = path
         return self
 
+    @function
+    def with_hashserv(self, service: Annotated[dagger.Service, HashservDoc]) -> Self:
+        self.hashserv = service
+        return self
+
+    @function
+    def with_prserv(self, service: Annotated[dagger.Service, PrservDoc]) -> Self:
+        self.prserv = service
+        return self
+
+    @function
+    def with_mirror(self, path: Annotated[dagger.Directory, MirrorDoc]) -> Self:
+        self.mirror = path
+        return self
+
+    @function
+    def with_sstate_mirror(
+        self,
+        service: Annotated[dagger.Service, SstateMirrorDoc],
+        upload: Annotated[bool, SstateMirrorUploadDoc] = False,
+    ) -> Self:
+        self.sstate_mirror = service
+        self.sstate_mirror_upload = upload
+        return self
+
+    @function
+    def with_cache_scope(
+        self,
+        scope: Annotated[str, CacheScopeDoc],
+        sstate: Annotated[bool, ScopeSstateDoc] = False,
+    ) -> Self:
+        self.cache_scope = scope
+        self.scope_sstate = sstate
+        return self
+
+    @function
+    def with_shared_caches(self) -> Self:
+        self.shared_caches = True
+        return self
+
     @function
     def build_dir(self) -> dagger.Directory:
         return self.container().directory(KAS_BUILD_DIR)
 
+    @function
+    def artifacts(
+        self,
+        include: Annotated[list[str] | None, ArtifactsIncludeDoc] = None,
+        exclude: Annotated[list[str] | None, ArtifactsExcludeDoc] = None,
+    ) -> dagger.Directory:
+        # Copy only the selected subtrees, so that exports scale with the size of the artifacts
+        # rather than with the size of the work tree
+        return dag.directory().with_directory(
+            ".",
+            self.build_dir(),
+            include=include or DEFAULT_ARTIFACTS_INCLUDE,
+            exclude=exclude,
+        )
+
     # Functions ------------------------------------------------------------------------------------
 
     @function
     async def with_prepare(
         self,
         extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+        hashserv_configs: Annotated[
+            list[str] | None, Name("hashserv-config"), HashservConfigDoc
+        ] = None,
+        prserv_configs: Annotated[list[str] | None, Name("prserv-config"), PrservConfigDoc] = None,
+        generate_mirror_tarballs: Annotated[bool, GenerateMirrorTarballsDoc] = False,
+        engine_share: Annotated[int | None, EngineShareDoc] = None,
+        bb_number_threads: Annotated[int | None, BbNumberThreadsDoc] = None,
+        parallel_make: Annotated[int | None, ParallelMakeDoc] = None,
+        pressure_max_cpu: Annotated[int | None, PressureMaxCpuDoc] = None,
+        pressure_max_io: Annotated[int | None, PressureMaxIoDoc] = None,
+        pressure_max_memory: Annotated[int | None, PressureMaxMemoryDoc] = None,
     ) -> Self:
+        # This expects the container to have a non-root user installed and currently active
+        non_root_user = await self._non_root_user(self.container())
+
+        if engine_share is not None:
+            threads = await self._engine_threads(engine_share)
+            bb_number_threads = bb_number_threads or threads
+            parallel_make = parallel_make or threads
+
         ctr = self.container()
 
-        # Query the current non-root user. This expects the container to have a non-root user
-        # installed and currently active
-        non_root_user = await ctr.user()
+        # Bitbake settings, rebuilt on each call and passed on by an overlay configuration
+        local_conf = []
 
         # Add credentials -----------------------------------------------------
 
@@ -121,10 +414,10 @@ class Kas:
 
         # Make Git trust any directory as otherwise git will refuse to run commands from the
         # non-root user. Requires Git 2.36 (Q2 2022). See https://stackoverflow.com/a/71940133
-        # Using git-config instead of plain file to allow for easier extension in other modules
-        ctr = ctr.with_env_variable("GITCONFIG_FILE", GITCONFIG_FILE).with_exec(
-            ["git", "config", "--file", "${GITCONFIG_FILE}", "--add", "safe.directory", "*"],
-            expand=True,
+        # Written as plain file to save an exec. Owned by the non-root user, so that other modules
+        # can still extend it with git-config
+        ctr = ctr.with_env_variable("GITCONFIG_FILE", GITCONFIG_FILE).with_new_file(
+            GITCONFIG_FILE, GITCONFIG_CONTENTS, owner=non_root_user
         )
 
         # Setup build directory -----------------------------------------------
@@ -145,34 +438,86 @@ class Kas:
 
         # Setup cache mounts --------------------------------------------------
 
+        # Concurrent builds always share downloads and sstate, which bitbake protects with lock
+        # files and publishes by atomic renames. The parse and repo ref caches are private copies
+        # unless shared caches are requested
         ctr = (
             ctr.with_mounted_cache(
                 KAS_REPO_REF_DIR,
-                dag.cache_volume(REPO_REF_CACHE_KEY, namespace="kas"),
-                sharing=dagger.CacheSharingMode.PRIVATE,
+                self._cache_volume(REPO_REF_CACHE_KEY),
+                sharing=self._cache_sharing(REPO_REF_CACHE_KEY),
                 owner=non_root_user,
             )
             .with_env_variable("KAS_REPO_REF_DIR", KAS_REPO_REF_DIR)
             .with_mounted_cache(
                 f"{KAS_BUILD_DIR}/cache",
-                dag.cache_volume(CACHE_CACHE_KEY, namespace="kas"),
-                sharing=dagger.CacheSharingMode.PRIVATE,
+                self._cache_volume(CACHE_CACHE_KEY),
+                sharing=self._cache_sharing(CACHE_CACHE_KEY),
                 owner=non_root_user,
             )
             .with_mounted_cache(
                 DL_DIR,
-                dag.cache_volume(DOWNLOADS_CACHE_KEY, namespace="kas"),
+                self._cache_volume(DOWNLOADS_CACHE_KEY),
+                sharing=self._cache_sharing(DOWNLOADS_CACHE_KEY),
                 owner=non_root_user,
             )
             .with_env_variable("DL_DIR", DL_DIR)
             .with_mounted_cache(
                 SSTATE_DIR,
-                dag.cache_volume(SSTATE_CACHE_KEY, namespace="kas"),
+                self._cache_volume(SSTATE_CACHE_KEY),
+                sharing=self._cache_sharing(SSTATE_CACHE_KEY),
                 owner=non_root_user,
             )
             .with_env_variable("SSTATE_DIR", SSTATE_DIR)
         )
 
+        # Setup mirrors -------------------------------------------------------
+
+        sstate_mirrors = []
+
+        # Seed the caches of a fresh engine from a previously exported mirror
+        if self.mirror is not None:
+            ctr = ctr.with_mounted_directory(MIRROR_DIR, self.mirror, owner=non_root_user)
+            premirrors = " ".join(
+                f"{scheme}://.*/.* file://{MIRROR_DIR}/{MIRROR_DOWNLOADS_DIR}/"
+                for scheme in MIRROR_SCHEMES
+            )
+            local_conf.append(f'PREMIRRORS:prepend = "{premirrors} "')
+            sstate_mirrors.append(f"file://.* file://{MIRROR_DIR}/{MIRROR_SSTATE_DIR}/PATH")
+
+        # Share sstate with other engines through an HTTP mirror, tried after the local mirror
+        if self.sstate_mirror is not None:
+            ctr = ctr.with_service_binding(SSTATE_MIRROR_ALIAS, self.sstate_mirror)
+            sstate_mirrors.append(
+                f"file://.* http://{SSTATE_MIRROR_ALIAS}:{SSTATE_MIRROR_PORT}/PATH"
+                ";downloadfilename=PATH"
+            )
+
+        if sstate_mirrors:
+            # Kas passes SSTATE_MIRRORS on to bitbake
+            ctr = ctr.with_env_variable("SSTATE_MIRRORS", " ".join(sstate_mirrors))
+
+        if generate_mirror_tarballs:
+            local_conf.append('BB_GENERATE_MIRROR_TARBALLS = "1"')
+
+        # Setup parallelism ---------------------------------------------------
+
+        # Kas passes BB_NUMBER_THREADS and PARALLEL_MAKE on to bitbake
+        if bb_number_threads is not None:
+            ctr = ctr.with_env_variable("BB_NUMBER_THREADS", str(bb_number_threads))
+
+        if parallel_make is not None:
+            ctr = ctr.with_env_variable("PARALLEL_MAKE", f"-j {parallel_make}")
+
+        # Let bitbake hold back new tasks while the engine is under pressure
+        for key, value in (
+            ("BB_PRESSURE_MAX_CPU", pressure_max_cpu),
+            ("BB_PRESSURE_MAX_IO", pressure_max_io),
+            ("BB_PRESSURE_MAX_MEMORY", pressure_max_memory),
+        ):
+            if value is not None:
+                local_conf.append(f'{key} = "{value}"')
+
         # Setup project directory ---------------------------------------------
 
         # Add the project directory last to improve caching
@@ -189,6 +534,60 @@ class Kas:
                 key, value = env_variable.split("=", 1)
                 ctr = ctr.with_env_variable(key, value)
 
+        # Setup hash equivalence ----------------------------------------------
+
+        # Started from the checkout of the fully prepared container as bitbake-hashserv is only
+        # available after checking out the layers providing bitbake. The service is
+        # content-addressed, so all builds sharing this container, e.g. in a build matrix, also
+        # share a single server
+        if hashserv_configs is not None:
+            self.hashserv = self._kas_shell_service(
+                ctr,
+                non_root_user,
+                hashserv_configs,
+                cache_key=HASHSERV_CACHE_KEY,
+                cache_dir=HASHSERV_DIR,
+                command=(
+                    f"exec bitbake-hashserv --bind 0.0.0.0:{HASHSERV_PORT}"
+                    f" --database {HASHSERV_DIR}/hashserv.db"
+                ),
+                port=HASHSERV_PORT,
+            )
+
+        if self.hashserv is not None:
+            ctr = ctr.with_service_binding(HASHSERV_ALIAS, self.hashserv)
+            local_conf.extend(
+                [
+                    'BB_SIGNATURE_HANDLER = "OEEquivHash"',
+                    f'BB_HASHSERVE = "{HASHSERV_ALIAS}:{HASHSERV_PORT}"',
+                ]
+            )
+
+        # Setup PR service ----------------------------------------------------
+
+        # Same as for hash equivalence, but with the sqlite database on its own cache volume. The
+        # server always daemonizes, so keep the service alive by following its log
+        if prserv_configs is not None:
+            self.prserv = self._kas_shell_service(
+                ctr,
+                non_root_user,
+                prserv_configs,
+                cache_key=PRSERV_CACHE_KEY,
+                cache_dir=PRSERV_DIR,
+                command=(
+                    f"bitbake-prserv --start --host 0.0.0.0 --port {PRSERV_PORT}"
+                    f" --file {PRSERV_DIR}/prserv.sqlite3 --log {PRSERV_LOG_FILEPATH}"
+                    f" && exec tail -F {PRSERV_LOG_FILEPATH}"
+                ),
+                port=PRSERV_PORT,
+            )
+
+        if self.prserv is not None:
+            ctr = ctr.with_service_binding(PRSERV_ALIAS, self.prserv)
+            local_conf.append(f'PRSERV_HOST = "{PRSERV_ALIAS}:{PRSERV_PORT}"')
+
+        self.local_conf = local_conf
+
         return self.with_container(ctr)
 
     @function
@@ -196,11 +595,35 @@ class Kas:
         self,
         src: Annotated[dagger.Directory, SrcDoc],
         extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+        hashserv_configs: Annotated[
+            list[str] | None, Name("hashserv-config"), HashservConfigDoc
+        ] = None,
+        prserv_configs: Annotated[list[str] | None, Name("prserv-config"), PrservConfigDoc] = None,
+        generate_mirror_tarballs: Annotated[bool, GenerateMirrorTarballsDoc] = False,
+        engine_share: Annotated[int | None, EngineShareDoc] = None,
+        bb_number_threads: Annotated[int | None, BbNumberThreadsDoc] = None,
+        parallel_make: Annotated[int | None, ParallelMakeDoc] = None,
+        pressure_max_cpu: Annotated[int | None, PressureMaxCpuDoc] = None,
+        pressure_max_io: Annotated[int | None, PressureMaxIoDoc] = None,
+        pressure_max_memory: Annotated[int | None, PressureMaxMemoryDoc] = None,
+        include: Annotated[list[str] | None, SrcIncludeDoc] = None,
+        exclude: Annotated[list[str] | None, SrcExcludeDoc] = None,
     ) -> dagger.Container:
+        self.with_container(self._base()).with_source(src, include=include, exclude=exclude)
+
         ctr = (
-            await self.with_container(self._base())
-            .with_source(src)
-            .with_prepare(extra_env_variables=extra_env_variables)
+            await self.with_prepare(
+                extra_env_variables=extra_env_variables,
+                hashserv_configs=hashserv_configs,
+                prserv_configs=prserv_configs,
+                generate_mirror_tarballs=generate_mirror_tarballs,
+                engine_share=engine_share,
+                bb_number_threads=bb_number_threads,
+                parallel_make=parallel_make,
+                pressure_max_cpu=pressure_max_cpu,
+                pressure_max_io=pressure_max_io,
+                pressure_max_memory=pressure_max_memory,
+            )
         ).container()
 
         # Set the result as the current container to ease subsequent calls
@@ -264,8 +687,37 @@ class Kas:
         return self.with_container(ctr)
 
     @function
-    def with_invalidate_layer_cache(self) -> Self:
-        return self.with_env_variable("DAGGERVERSE_KAS_CACHE_BUSTER", str(datetime.now()))
+    async def with_invalidate_layer_cache(
+        self,
+        key: Annotated[str | None, InvalidateKeyDoc] = None,
+        ttl: Annotated[int | None, InvalidateTtlDoc] = None,
+        lock_file: Annotated[dagger.File | None, InvalidateLockFileDoc] = None,
+        configs: Annotated[list[str] | None, Name("config"), InvalidateConfigDoc] = None,
+    ) -> Self:
+        if ttl is not None and ttl <= 0:
+            raise ValueError(f"Expected a positive ttl in seconds, got {ttl}")
+
+        # Derive the buster from content signals, so that subsequent steps only re-run when their
+        # inputs actually moved
+        signals = []
+
+        if key is not None:
+            signals.append(key)
+
+        if lock_file is not None:
+            signals.append(await lock_file.digest())
+
+        if configs is not None:
+            signals.append(await self._resolve_refs(configs))
+
+        if ttl is not None:
+            signals.append(str(int(datetime.now().timestamp()) // ttl))
+
+        # Without any signal, always invalidate
+        if not signals:
+            signals.append(str(datetime.now()))
+
+        return self.with_env_variable(CACHE_BUSTER_ENV_VARIABLE, ":".join(signals))
 
     @function
     def with_kas(
@@ -332,6 +784,40 @@ class Kas:
 
         return self.with_kas(args)
 
+    @function
+    async def with_resolved_refs(
+        self,
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+    ) -> Self:
+        # Key all subsequent steps on the exact SHAs, so that an unchanged upstream reuses the
+        # cached checkout while a moved ref re-runs it
+        refs = await self._resolve_refs(configs)
+        return self.with_env_variable(RESOLVED_REFS_ENV_VARIABLE, refs)
+
+    @function
+    async def with_warm_repo_refs(
+        self,
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        jobs: Annotated[int, JobsDoc] = 8,
+    ) -> Self:
+        # Populate the reference repositories before kas clones from them
+        await self._warm_repo_refs(configs, jobs)
+        return self
+
+    @function
+    async def warm_repo_refs(
+        self,
+        src: Annotated[dagger.Directory, SrcDoc],
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        jobs: Annotated[int, JobsDoc] = 8,
+        extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+    ) -> str:
+        await self.prepare(src=src, extra_env_variables=extra_env_variables)
+
+        return await self._warm_repo_refs(configs, jobs)
+
     @function
     async def checkout(
         self,
@@ -342,9 +828,13 @@ class Kas:
         update: Annotated[bool, UpdateDoc] = False,
         extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
         extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+        key_on_refs: Annotated[bool, KeyOnRefsDoc] = False,
     ) -> dagger.Directory:
         await self.prepare(src=src, extra_env_variables=extra_env_variables)
 
+        if key_on_refs:
+            await self.with_resolved_refs(configs)
+
         src = self.with_checkout(
             configs,
             force_checkout=force_checkout,
@@ -393,7 +883,9 @@ class Kas:
 
         ctr = self.with_kas(args, redirect_stdout=DUMP_STDOUT_FILEPATH).container()
 
-        return WithDumpResult(kas=self, result=ctr.file(DUMP_STDOUT_FILEPATH))  # type: ignore
+        result = ctr.file(DUMP_STDOUT_FILEPATH)
+
+        return WithDumpResult(kas=self, result=result, config=self._to_json(result))  # type: ignore
 
     @function
     async def dump(
@@ -436,9 +928,14 @@ class Kas:
         update: Annotated[bool, UpdateDoc] = False,
         keep_config_unchanged: Annotated[bool, KeepConfigUnchangedDoc] = False,
         target: Annotated[str | None, TargetDoc] = None,
+        targets: Annotated[list[str] | None, TargetsDoc] = None,
         task: Annotated[str | None, TaskDoc] = None,
         extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
         expect: Annotated[dagger.ReturnType | None, ExpectDoc] = dagger.ReturnType.SUCCESS,
+        buildstats: Annotated[bool, BuildstatsDoc] = False,
+        tmpfs_size: Annotated[int | None, TmpfsSizeDoc] = None,
+        rm_work: Annotated[bool, RmWorkDoc] = False,
+        rm_work_exclude: Annotated[list[str] | None, RmWorkExcludeDoc] = None,
     ) -> Self:
         args = ["build"]
 
@@ -451,21 +948,103 @@ class Kas:
         if keep_config_unchanged:
             args.append("--keep-config-unchanged")
 
-        if target is not None:
-            args.extend(["--target", target])
+        all_targets = [*([target] if target is not None else []), *(targets or [])]
+
+        if len(all_targets) == 1:
+            args.extend(["--target", all_targets[0]])
 
         if task is not None:
             args.extend(["--task", task])
 
         args.extend(extra_args or [])
 
+        local_conf = []
+
+        if buildstats:
+            local_conf.append('INHERIT += "buildstats"')
+
+        if rm_work or rm_work_exclude:
+            local_conf.append('INHERIT += "rm_work"')
+
+        if rm_work_exclude:
+            local_conf.append(f'RM_WORK_EXCLUDE += "{" ".join(rm_work_exclude)}"')
+
+        configs, overlay = self._with_overlay(configs, local_conf)
         if configs is not None:
             args.append(format_config_arg(configs))
 
         if extra_bitbake_args:
             args.extend(["--", *extra_bitbake_args])
 
-        return self.with_kas(args, expect=expect)
+        ctr = self.container()
+
+        if tmpfs_size is not None:
+            # Only the work directories go to memory, while deploy, stamps and sstate stay on
+            # disk. The parent directory is created first to keep it owned by the build user
+            ctr = ctr.with_exec(["mkdir", "-p", f"{KAS_BUILD_DIR}/tmp"]).with_mounted_temp(
+                BUILD_WORK_DIR, size=tmpfs_size
+            )
+
+        if len(all_targets) > 1:
+            # Kas-compatible override passing all targets to a single bitbake invocation, so that
+            # they are scheduled in one runqueue
+            ctr = ctr.with_env_variable("KAS_TARGET", " ".join(all_targets))
+
+        upload = self.sstate_mirror is not None and self.sstate_mirror_upload
+        if upload:
+            # Marks the start of the build, so that only newer objects are considered for upload
+            ctr = ctr.with_exec(["touch", SSTATE_PUSH_MARKER_FILEPATH])
+
+        # Keep a copy of the output while still streaming it, as knotty prints the tasks summary
+        # to stdout only and not to the console log
+        self.with_container(ctr).with_exec(
+            [
+                "bash",
+                "-o",
+                "pipefail",
+                "-c",
+                f'kas "$@" | tee {BUILD_STDOUT_FILEPATH}',
+                "kas",
+                *args,
+            ],
+            expect=expect,
+        )
+
+        if upload:
+            # Objects fetched from the mirror are newer as well, but skipped as already present
+            self.with_container(
+                self._with_script(
+                    self.container(),
+                    "sstate_mirror.py",
+                    [
+                        "push",
+                        SSTATE_DIR,
+                        f"http://{SSTATE_MIRROR_ALIAS}:{SSTATE_MIRROR_PORT}",
+                        "--newer-than",
+                        SSTATE_PUSH_MARKER_FILEPATH,
+                    ],
+                )
+            )
+
+        # Unset the per-build overrides afterwards to not leak into later builds. The stamps of
+        # the dropped work directories go as well, so that later builds restore them from sstate
+        # instead of skipping tasks whose output is gone
+        ctr = self.container()
+        if overlay is not None:
+            ctr = ctr.without_file(overlay)
+        if len(all_targets) > 1:
+            ctr = ctr.without_env_variable("KAS_TARGET")
+        if tmpfs_size is not None:
+            ctr = ctr.with_exec(
+                [
+                    "sh",
+                    "-c",
+                    f"cd {BUILD_WORK_DIR} && for dir in */*/; do"
+                    f' rm -rf "{BUILD_STAMPS_DIR}/$dir"; done',
+                ]
+            ).without_mount(BUILD_WORK_DIR)
+
+        return self.with_container(ctr)
 
     @function
     async def build(
@@ -478,11 +1057,26 @@ class Kas:
         update: Annotated[bool, UpdateDoc] = False,
         keep_config_unchanged: Annotated[bool, KeepConfigUnchangedDoc] = False,
         target: Annotated[str | None, TargetDoc] = None,
+        targets: Annotated[list[str] | None, TargetsDoc] = None,
         task: Annotated[str | None, TaskDoc] = "build",
         extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
         extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+        hash_equivalence: Annotated[bool, HashEquivalenceDoc] = False,
+        pr_service: Annotated[bool, PrServiceDoc] = False,
+        tmpfs_size: Annotated[int | None, TmpfsSizeDoc] = None,
+        rm_work: Annotated[bool, RmWorkDoc] = False,
+        rm_work_exclude: Annotated[list[str] | None, RmWorkExcludeDoc] = None,
+        key_on_refs: Annotated[bool, KeyOnRefsDoc] = False,
     ) -> dagger.Directory:
-        await self.prepare(src=src, extra_env_variables=extra_env_variables)
+        await self.prepare(
+            src=src,
+            extra_env_variables=extra_env_variables,
+            hashserv_configs=configs if hash_equivalence else None,
+            prserv_configs=configs if pr_service else None,
+        )
+
+        if key_on_refs:
+            await self.with_resolved_refs(configs)
 
         build_dir = self.with_build(
             configs,
@@ -491,12 +1085,206 @@ class Kas:
             update=update,
             keep_config_unchanged=keep_config_unchanged,
             target=target,
+            targets=targets,
             task=task,
             extra_args=extra_args,
+            tmpfs_size=tmpfs_size,
+            rm_work=rm_work,
+            rm_work_exclude=rm_work_exclude,
         ).build_dir()
 
         return await build_dir.sync()
 
+    @function
+    async def build_artifacts(
+        self,
+        src: Annotated[dagger.Directory, SrcDoc],
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        extra_bitbake_args: Annotated[list[str] | None, ExtraBitbakeArgsDoc] = None,
+        force_checkout: Annotated[bool, ForceCheckoutDoc] = False,
+        update: Annotated[bool, UpdateDoc] = False,
+        keep_config_unchanged: Annotated[bool, KeepConfigUnchangedDoc] = False,
+        target: Annotated[str | None, TargetDoc] = None,
+        targets: Annotated[list[str] | None, TargetsDoc] = None,
+        task: Annotated[str | None, TaskDoc] = "build",
+        extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
+        extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+        hash_equivalence: Annotated[bool, HashEquivalenceDoc] = False,
+        pr_service: Annotated[bool, PrServiceDoc] = False,
+        tmpfs_size: Annotated[int | None, TmpfsSizeDoc] = None,
+        rm_work: Annotated[bool, RmWorkDoc] = False,
+        rm_work_exclude: Annotated[list[str] | None, RmWorkExcludeDoc] = None,
+        key_on_refs: Annotated[bool, KeyOnRefsDoc] = False,
+        include: Annotated[list[str] | None, ArtifactsIncludeDoc] = None,
+        exclude: Annotated[list[str] | None, ArtifactsExcludeDoc] = None,
+    ) -> dagger.Directory:
+        await self.prepare(
+            src=src,
+            extra_env_variables=extra_env_variables,
+            hashserv_configs=configs if hash_equivalence else None,
+            prserv_configs=configs if pr_service else None,
+        )
+
+        if key_on_refs:
+            await self.with_resolved_refs(configs)
+
+        artifacts = self.with_build(
+            configs,
+            extra_bitbake_args=extra_bitbake_args,
+            force_checkout=force_checkout,
+            update=update,
+            keep_config_unchanged=keep_config_unchanged,
+            target=target,
+            targets=targets,
+            task=task,
+            extra_args=extra_args,
+            tmpfs_size=tmpfs_size,
+            rm_work=rm_work,
+            rm_work_exclude=rm_work_exclude,
+        ).artifacts(include=include, exclude=exclude)
+
+        return await artifacts.sync()
+
+    @function
+    async def build_matrix(
+        self,
+        src: Annotated[dagger.Directory, SrcDoc],
+        config_sets: Annotated[list[str], Name("config-set"), ConfigSetDoc],
+        *,
+        machines: Annotated[list[str] | None, Name("machine"), MachinesDoc] = None,
+        extra_bitbake_args: Annotated[list[str] | None, ExtraBitbakeArgsDoc] = None,
+        force_checkout: Annotated[bool, ForceCheckoutDoc] = False,
+        update: Annotated[bool, UpdateDoc] = False,
+        keep_config_unchanged: Annotated[bool, KeepConfigUnchangedDoc] = False,
+        target: Annotated[str | None, TargetDoc] = None,
+        targets: Annotated[list[str] | None, TargetsDoc] = None,
+        task: Annotated[str | None, TaskDoc] = "build",
+        extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
+        extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+        hash_equivalence: Annotated[bool, HashEquivalenceDoc] = False,
+        pr_service: Annotated[bool, PrServiceDoc] = False,
+        tmpfs_size: Annotated[int | None, TmpfsSizeDoc] = None,
+        rm_work: Annotated[bool, RmWorkDoc] = False,
+        rm_work_exclude: Annotated[list[str] | None, RmWorkExcludeDoc] = None,
+        key_on_refs: Annotated[bool, KeyOnRefsDoc] = False,
+        split_resources: Annotated[bool, SplitResourcesDoc] = False,
+    ) -> list["BuildMatrixResult"]:
+        # Prepare once and share the container (and thus its cache mounts and services) across
+        # all entries. Services are started from the first configuration set
+        await self.prepare(
+            src=src,
+            extra_env_variables=extra_env_variables,
+            hashserv_configs=config_sets[0].split(":") if hash_equivalence else None,
+            prserv_configs=config_sets[0].split(":") if pr_service else None,
+            engine_share=len(config_sets) * len(machines or [None]) if split_resources else None,
+        )
+
+        async def run(config_set: str, machine: str | None) -> BuildMatrixResult:
+            kas = self._fork()
+
+            if key_on_refs:
+                # Each configuration set may pull in different repositories
+                kas = await kas.with_resolved_refs(config_set.split(":"))
+
+            if machine is not None:
+                # Kas-compatible override of the machine set in the configuration
+                kas = kas.with_env_variable("KAS_MACHINE", machine)
+
+            ctr = kas.with_build(
+                config_set.split(":"),
+                extra_bitbake_args=extra_bitbake_args,
+                force_checkout=force_checkout,
+                update=update,
+                keep_config_unchanged=keep_config_unchanged,
+                target=target,
+                targets=targets,
+                task=task,
+                extra_args=extra_args,
+                expect=dagger.ReturnType.ANY,
+                tmpfs_size=tmpfs_size,
+                rm_work=rm_work,
+                rm_work_exclude=rm_work_exclude,
+            ).container()
+
+            start = time.monotonic()
+            exit_code = await ctr.exit_code()
+            duration = time.monotonic() - start
+
+            return BuildMatrixResult(
+                config=config_set,
+                machine=machine,
+                build_dir=ctr.directory(KAS_BUILD_DIR),
+                exit_code=exit_code,
+                duration=duration,
+            )  # type: ignore
+
+        return await asyncio.gather(
+            *(
+                run(config_set, machine)
+                for config_set in config_sets
+                for machine in (machines or [None])
+            )
+        )
+
+    @function
+    def with_fetch(
+        self,
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        extra_bitbake_args: Annotated[list[str] | None, ExtraBitbakeArgsDoc] = None,
+        force_checkout: Annotated[bool, ForceCheckoutDoc] = False,
+        update: Annotated[bool, UpdateDoc] = False,
+        keep_config_unchanged: Annotated[bool, KeepConfigUnchangedDoc] = False,
+        target: Annotated[str | None, TargetDoc] = None,
+        extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
+        expect: Annotated[dagger.ReturnType | None, ExpectDoc] = dagger.ReturnType.SUCCESS,
+    ) -> Self:
+        # Only run the fetch tasks of the target's task graph, populating the downloads cache
+        return self.with_build(
+            configs,
+            extra_bitbake_args=["--runall=fetch", *(extra_bitbake_args or [])],
+            force_checkout=force_checkout,
+            update=update,
+            keep_config_unchanged=keep_config_unchanged,
+            target=target,
+            extra_args=extra_args,
+            expect=expect,
+        )
+
+    @function
+    async def fetch(
+        self,
+        src: Annotated[dagger.Directory, SrcDoc],
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        extra_bitbake_args: Annotated[list[str] | None, ExtraBitbakeArgsDoc] = None,
+        force_checkout: Annotated[bool, ForceCheckoutDoc] = False,
+        update: Annotated[bool, UpdateDoc] = False,
+        keep_config_unchanged: Annotated[bool, KeepConfigUnchangedDoc] = False,
+        target: Annotated[str | None, TargetDoc] = None,
+        extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
+        extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+        generate_mirror_tarballs: Annotated[bool, GenerateMirrorTarballsDoc] = False,
+    ) -> dagger.Container:
+        await self.prepare(
+            src=src,
+            extra_env_variables=extra_env_variables,
+            generate_mirror_tarballs=generate_mirror_tarballs,
+        )
+
+        ctr = self.with_fetch(
+            configs,
+            extra_bitbake_args=extra_bitbake_args,
+            force_checkout=force_checkout,
+            update=update,
+            keep_config_unchanged=keep_config_unchanged,
+            target=target,
+            extra_args=extra_args,
+        ).container()
+
+        return await ctr.sync()
+
     @function
     def with_shell(
         self,
@@ -527,10 +1315,17 @@ class Kas:
 
         args.extend(extra_args or [])
 
+        configs, overlay = self._with_overlay(configs)
         if configs is not None:
             args.append(format_config_arg(configs))
 
-        return self.with_kas(args, expand=expand, expect=expect)
+        self.with_kas(args, expand=expand, expect=expect)
+
+        # Keep the overlay out of the work directory, e.g. an exported source directory
+        if overlay is not None:
+            self.with_container(self.container().without_file(overlay))
+
+        return self
 
     @function
     async def shell(
@@ -562,6 +1357,79 @@ class Kas:
 
         return ctr
 
+    @function
+    def with_shell_session(
+        self,
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        commands: Annotated[list[str], CommandsDoc],
+        server_timeout: Annotated[int, ServerTimeoutDoc] = 60,
+        force_checkout: Annotated[bool, ForceCheckoutDoc] = False,
+        update: Annotated[bool, UpdateDoc] = False,
+        preserve_env: Annotated[bool, PreserveEnvDoc] = False,
+        keep_config_unchanged: Annotated[bool, KeepConfigUnchangedDoc] = False,
+        extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
+        expect: Annotated[dagger.ReturnType | None, ExpectDoc] = dagger.ReturnType.SUCCESS,
+    ) -> "WithShellSessionResult":
+        script = f"{SCRIPTS_MOUNT_DIR}/shell_session.py"
+
+        self.with_container(
+            self.container()
+            .with_mounted_file(script, script_file("shell_session.py"))
+            .with_new_file(SHELL_SESSION_COMMANDS_FILEPATH, json.dumps(commands))
+        )
+
+        # Run all commands from a single kas shell, so that they share one memory resident bitbake
+        # server and thus only parse the metadata once
+        ctr = self.with_shell(
+            configs,
+            command=(
+                f"python3 {script} {SHELL_SESSION_COMMANDS_FILEPATH}"
+                f" {SHELL_SESSION_RESULTS_FILEPATH} --server-timeout {server_timeout}"
+            ),
+            force_checkout=force_checkout,
+            update=update,
+            preserve_env=preserve_env,
+            keep_config_unchanged=keep_config_unchanged,
+            extra_args=extra_args,
+            expect=expect,
+        ).container()
+
+        return WithShellSessionResult(
+            kas=self,
+            result=ctr.file(SHELL_SESSION_RESULTS_FILEPATH),
+        )  # type: ignore
+
+    @function
+    async def shell_session(
+        self,
+        src: Annotated[dagger.Directory, SrcDoc],
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        commands: Annotated[list[str], CommandsDoc],
+        server_timeout: Annotated[int, ServerTimeoutDoc] = 60,
+        force_checkout: Annotated[bool, ForceCheckoutDoc] = False,
+        update: Annotated[bool, UpdateDoc] = False,
+        preserve_env: Annotated[bool, PreserveEnvDoc] = False,
+        keep_config_unchanged: Annotated[bool, KeepConfigUnchangedDoc] = False,
+        extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
+        extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+    ) -> list["ShellCommandResult"]:
+        await self.prepare(src=src, extra_env_variables=extra_env_variables)
+
+        with_shell_session_result = self.with_shell_session(
+            configs,
+            commands=commands,
+            server_timeout=server_timeout,
+            force_checkout=force_checkout,
+            update=update,
+            preserve_env=preserve_env,
+            keep_config_unchanged=keep_config_unchanged,
+            extra_args=extra_args,
+        )
+
+        return await with_shell_session_result.results()
+
     @function
     def with_for_all_repos(
         self,
@@ -603,6 +1471,66 @@ class Kas:
 
         return ctr
 
+    @function
+    def with_for_all_repos_parallel(
+        self,
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        command: Annotated[str, CommandDoc],
+        jobs: Annotated[int, JobsDoc] = 8,
+        extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
+    ) -> "WithForAllReposParallelResult":
+        # Let kas check out the repositories and capture the environment it provides for each of
+        # them, which is fast even for many repositories
+        self.with_container(self.container().with_exec(["rm", "-f", FOR_ALL_REPOS_REPOS_FILEPATH]))
+        self.with_for_all_repos(
+            configs,
+            command=f"{REPO_ENV_COMMAND} >> {FOR_ALL_REPOS_REPOS_FILEPATH}",
+            extra_args=extra_args,
+        )
+
+        # Then fan the command out over the repositories from a single exec. Failures are
+        # reported per repository instead of failing the exec
+        ctr = self._with_script(
+            self.container(),
+            "for_all_repos.py",
+            [
+                FOR_ALL_REPOS_REPOS_FILEPATH,
+                command,
+                FOR_ALL_REPOS_RESULTS_FILEPATH,
+                "--jobs",
+                str(jobs),
+            ],
+        )
+        self.with_container(ctr)
+
+        return WithForAllReposParallelResult(
+            kas=self,
+            result=ctr.file(FOR_ALL_REPOS_RESULTS_FILEPATH),
+        )  # type: ignore
+
+    @function
+    async def for_all_repos_parallel(
+        self,
+        src: Annotated[dagger.Directory, SrcDoc],
+        configs: Annotated[list[str] | None, Name("config"), ConfigDoc] = None,
+        *,
+        command: Annotated[str, CommandDoc],
+        jobs: Annotated[int, JobsDoc] = 8,
+        extra_args: Annotated[list[str] | None, ExtraArgsDoc] = None,
+        extra_env_variables: Annotated[list[str] | None, ExtraEnvVariablesDoc] = None,
+    ) -> list["RepoCommandResult"]:
+        await self.prepare(src=src, extra_env_variables=extra_env_variables)
+
+        with_for_all_repos_parallel_result = self.with_for_all_repos_parallel(
+            configs,
+            command=command,
+            jobs=jobs,
+            extra_args=extra_args,
+        )
+
+        return await with_for_all_repos_parallel_result.results()
+
     @function
     def with_lock(
         self,
@@ -627,7 +1555,9 @@ class Kas:
 
         ctr = self.with_kas(args, redirect_stdout=LOCK_STDOUT_FILEPATH).container()
 
-        return WithLockResult(kas=self, result=ctr.file(LOCK_STDOUT_FILEPATH))  # type: ignore
+        result = ctr.file(LOCK_STDOUT_FILEPATH)
+
+        return WithLockResult(kas=self, result=result, config=self._to_json(result))  # type: ignore
 
     @function
     async def lock(
@@ -651,8 +1581,462 @@ class Kas:
 
         return with_lock_result.result
 
+    @function
+    def export_mirror(self) -> dagger.Directory:
+        # Cache volumes are not part of the cache key, thus always re-run the copy
+        ctr = self.container().with_env_variable(CACHE_BUSTER_ENV_VARIABLE, str(datetime.now()))
+
+        downloads_dir = f"{MIRROR_EXPORT_DIR}/{MIRROR_DOWNLOADS_DIR}"
+        sstate_dir = f"{MIRROR_EXPORT_DIR}/{MIRROR_SSTATE_DIR}"
+
+        # Skip bare git clones in favour of their mirror tarballs, as well as fetcher state.
+        # Clones fetched without generating mirror tarballs are packed the same way bitbake does
+        ctr = (
+            ctr.with_exec(["mkdir", "-p", downloads_dir, sstate_dir])
+            .with_exec(
+                [
+                    "sh",
+                    "-c",
+                    f"tar -C {DL_DIR} --exclude=./git2 --exclude=./svn --exclude='*.lock'"
+                    f" --exclude='*.done' -cf - . | tar -C {downloads_dir} -xf -",
+                ]
+            )
+            .with_exec(
+                [
+                    "sh",
+                    "-c",
+                    f"for clone in {DL_DIR}/git2/*/; do"
+                    ' [ -d "$clone" ] || continue;'
+                    f' tarball="{downloads_dir}/git2_$(basename "$clone").tar.gz";'
+                    ' [ -e "$tarball" ] || tar -C "$clone" -czf "$tarball" .;'
+                    " done",
+                ]
+            )
+            .with_exec(
+                [
+                    "sh",
+                    "-c",
+                    f"tar -C {SSTATE_DIR} --exclude='*.lock' -cf - . | tar -C {sstate_dir} -xf -",
+                ]
+            )
+        )
+
+        return ctr.directory(MIRROR_EXPORT_DIR)
+
+    @function
+    async def build_report(self) -> "BuildReport":
+        # Requires a preceding build with buildstats enabled
+        ctr = self._with_script(
+            self.container(),
+            "build_report.py",
+            [KAS_BUILD_DIR, "--build-stdout", BUILD_STDOUT_FILEPATH],
+            redirect_stdout=BUILD_REPORT_FILEPATH,
+        )
+
+        report_file = ctr.file(BUILD_REPORT_FILEPATH)
+        report = json.loads(await report_file.contents())
+
+        return BuildReport(
+            build_dir=self.build_dir(),
+            report=report_file,
+            elapsed=report["elapsed"],
+            cpu=report["cpu"],
+            critical_path=report["critical_path"],
+            sstate_wanted=report["sstate"]["wanted"],
+            sstate_local=report["sstate"]["local"],
+            sstate_mirrors=report["sstate"]["mirrors"],
+            sstate_missed=report["sstate"]["missed"],
+            sstate_current=report["sstate"]["current"],
+        )  # type: ignore
+
+    @function
+    async def sstate_mirror_service(
+        self,
+        accept_uploads: Annotated[bool, AcceptUploadsDoc] = False,
+    ) -> dagger.Service:
+        ctr = self._base()
+        non_root_user = await self._non_root_user(ctr)
+
+        script = f"{SCRIPTS_MOUNT_DIR}/sstate_mirror.py"
+        args = ["python3", script, "serve", SSTATE_DIR, "--port", str(SSTATE_MIRROR_PORT)]
+
+        if not accept_uploads:
+            args.append("--read-only")
+
+        # Serves the sstate cache volume of this engine, including objects added by local builds
+        return (
+            ctr.with_mounted_cache(
+                SSTATE_DIR,
+                self._cache_volume(SSTATE_CACHE_KEY),
+                sharing=self._cache_sharing(SSTATE_CACHE_KEY),
+                owner=non_root_user,
+            )
+            .with_mounted_file(script, script_file("sstate_mirror.py"))
+            .with_exposed_port(SSTATE_MIRROR_PORT)
+            .as_service(args=args)
+        )
+
+    @function
+    def failed_task_logs(
+        self,
+        console_tail: Annotated[int, ConsoleTailDoc] = 0,
+    ) -> dagger.Directory:
+        # Requires a preceding build, e.g. with expect=ANY to not fail the pipeline. Collects the
+        # logs bitbake reports for failed tasks instead of exporting the whole build directory
+        build_report_script = f"{SCRIPTS_MOUNT_DIR}/build_report.py"
+
+        ctr = self._with_script(
+            self.container().with_mounted_file(build_report_script, script_file("build_report.py")),
+            "failed_task_logs.py",
+            [KAS_BUILD_DIR, FAILED_TASK_LOGS_DIR, "--console-tail", str(console_tail)],
+        )
+
+        return ctr.directory(FAILED_TASK_LOGS_DIR)
+
+    @function
+    async def image_container(
+        self,
+        image: Annotated[str, ImageDoc],
+        machine: Annotated[str, MachineDoc],
+        platform: Annotated[dagger.Platform | None, PlatformDoc] = None,
+    ) -> dagger.Container:
+        # Requires a preceding build of the image with a tar type in IMAGE_FSTYPES. The link
+        # without timestamp points to the rootfs of the latest build
+        pattern = f"tmp*/deploy/images/{machine}/{image}-{machine}.rootfs.tar*"
+        tarballs = [
+            path
+            for path in await self.build_dir().glob(pattern)
+            if path.endswith(tuple(ROOTFS_TARBALL_SUFFIXES))
+        ]
+
+        if not tarballs:
+            raise ValueError(f"Expected a rootfs tarball matching {pattern} in the build directory")
+
+        # Only mount the deploy directory of the machine, so that the extraction is cached for as
+        # long as the images don't change. Extract as root to keep the ownership of the files, but
+        # leave device nodes to the container runtime
+        tarball = sorted(tarballs)[0]
+        rootfs = (
+            self._base()
+            .with_user("root")
+            .with_mounted_directory(
+                DEPLOY_IMAGES_DIR, self.build_dir().directory(os.path.dirname(tarball))
+            )
+            .with_exec(["mkdir", "-p", ROOTFS_DIR])
+            .with_exec(
+                [
+                    "tar",
+                    "--extract",
+                    "--numeric-owner",
+                    "--preserve-permissions",
+                    "--xattrs",
+                    "--exclude=./dev/*",
+                    "--file",
+                    f"{DEPLOY_IMAGES_DIR}/{os.path.basename(tarball)}",
+                    "--directory",
+                    ROOTFS_DIR,
+                ]
+            )
+            .directory(ROOTFS_DIR)
+        )
+
+        return dag.container(platform=platform).with_rootfs(rootfs)
+
+    @function
+    async def cache_stats(self) -> "CacheStats":
+        # Cache volumes are not part of the cache key, thus always re-run the collection
+        ctr = self.container().with_env_variable(CACHE_BUSTER_ENV_VARIABLE, str(datetime.now()))
+
+        args = [KAS_BUILD_DIR, "--build-stdout", BUILD_STDOUT_FILEPATH, "--downloads-dir", DL_DIR]
+        args.extend(f"--cache={key}={path}" for key, path in CACHE_VOLUMES.items())
+
+        report = json.loads(await self._with_script(ctr, "build_report.py", args).stdout())
+        sstate = report["sstate"]
+        sstate_found = sstate["local"] + sstate["mirrors"]
+
+        return CacheStats(
+            sstate_wanted=sstate["wanted"],
+            sstate_found=sstate_found,
+            sstate_missed=sstate["missed"],
+            sstate_hit_rate=sstate_found / sstate["wanted"] if sstate["wanted"] else 0.0,
+            tasks_attempted=report["tasks"]["attempted"],
+            tasks_reused=report["tasks"]["reused"],
+            downloads_fetched=report["downloads"]["fetched"],
+            downloads_cached=report["downloads"]["cached"],
+            volumes=[
+                CacheVolumeStats(key=key, path=CACHE_VOLUMES[key], size=size)  # type: ignore
+                for key, size in report["caches"].items()
+            ],
+        )  # type: ignore
+
+    @function
+    async def prune_sstate(
+        self,
+        max_size: Annotated[int | None, MaxSizeDoc] = None,
+        max_age: Annotated[int | None, MaxAgeDoc] = None,
+        order: Annotated[str, PruneOrderDoc] = "atime",
+    ) -> "PruneReport":
+        # Evict sstate objects together with their siginfo files
+        return await self._prune_cache(
+            SSTATE_CACHE_KEY,
+            SSTATE_DIR,
+            unit="file",
+            max_size=max_size,
+            max_age=max_age,
+            order=order,
+        )
+
+    @function
+    async def prune_downloads(
+        self,
+        max_size: Annotated[int | None, MaxSizeDoc] = None,
+        max_age: Annotated[int | None, MaxAgeDoc] = None,
+        order: Annotated[str, PruneOrderDoc] = "atime",
+    ) -> "PruneReport":
+        # Evict top-level entries only, as e.g. bare git clones must be removed as a whole
+        return await self._prune_cache(
+            DOWNLOADS_CACHE_KEY,
+            DL_DIR,
+            unit="entry",
+            max_size=max_size,
+            max_age=max_age,
+            order=order,
+        )
+
+    @function
+    async def prune_repo_refs(
+        self,
+        max_size: Annotated[int | None, MaxSizeDoc] = None,
+        max_age: Annotated[int | None, MaxAgeDoc] = None,
+        order: Annotated[str, PruneOrderDoc] = "atime",
+    ) -> "PruneReport":
+        return await self._prune_cache(
+            REPO_REF_CACHE_KEY,
+            KAS_REPO_REF_DIR,
+            unit="entry",
+            max_size=max_size,
+            max_age=max_age,
+            order=order,
+        )
+
     # Internals ------------------------------------------------------------------------------------
 
+    def _kas_shell_service(
+        self,
+        ctr: dagger.Container,
+        non_root_user: str,
+        configs: list[str] | None,
+        *,
+        cache_key: str,
+        cache_dir: str,
+        command: str,
+        port: int,
+    ) -> dagger.Service:
+        config_args = [format_config_arg(configs)] if configs is not None else []
+
+        # Check out the layers in the prepared container, but copy the objects borrowed from the
+        # repo ref cache into each repository, so that the checkout stands on its own
+        checkout = ctr.with_exec(
+            ["for-all-repos", *config_args, DISSOCIATE_REPO_COMMAND], use_entrypoint=True
+        ).directory(KAS_WORK_DIR)
+
+        # Run the service from a container with only the checkout and its own cache volume. A
+        # long-running service holding the private cache volumes of the build would force
+        # concurrent builds onto fresh copies of them
+        service_ctr = (
+            self._base()
+            .with_mounted_directory(
+                KAS_BUILD_DIR,
+                dag.directory()
+                .with_new_directory(KAS_BUILD_DIR, permissions=0o755)
+                .directory(KAS_BUILD_DIR),
+                owner=non_root_user,
+            )
+            .with_env_variable("KAS_BUILD_DIR", KAS_BUILD_DIR)
+            .with_mounted_cache(cache_dir, self._cache_volume(cache_key), owner=non_root_user)
+            .with_env_variable("KAS_WORK_DIR", KAS_WORK_DIR)
+            .with_mounted_directory(KAS_WORK_DIR, checkout, owner=non_root_user)
+            .with_workdir(KAS_WORK_DIR)
+            .with_exposed_port(port)
+        )
+
+        # Run the command from within the kas shell, so that bitbake tools are on the path
+        return service_ctr.as_service(
+            args=["shell", "-c", command, *config_args], use_entrypoint=True
+        )
+
+    def _with_overlay(
+        self, configs: list[str] | None, local_conf: list[str] | None = None
+    ) -> tuple[list[str] | None, str | None]:
+        # Kas only passes a fixed set of environment variables on to bitbake, thus the bitbake
+        # settings of this module reach local.conf through an overlay appended to the configuration.
+        # Returns the overlay's path, which the caller removes again after running kas
+        local_conf = [*self.local_conf, *(local_conf or [])]
+        if not local_conf:
+            return configs, None
+
+        if not configs:
+            raise ValueError("Expected at least one configuration file to apply bitbake settings")
+
+        filepath = str(Path(KAS_WORK_DIR, configs[0]).parent / OVERLAY_FILENAME)
+        overlay = {
+            "header": {"version": 14},
+            "local_conf_header": {OVERLAY_LOCAL_CONF_HEADER: "\n".join(local_conf)},
+        }
+        self.with_container(self.container().with_new_file(filepath, json.dumps(overlay)))
+
+        return [*configs, filepath], filepath
+
+    async def _non_root_user(self, ctr: dagger.Container) -> str:
+        # Querying the user takes an engine round trip, thus resolve it once per object unless
+        # the caller already passed it
+        if self.non_root_user is None:
+            self.non_root_user = await ctr.user()
+
+        return self.non_root_user
+
+    async def _engine_threads(self, share: int) -> int:
+        # Engine resources may change between runs, thus always re-run the detection
+        ctr = self.container().with_env_variable(CACHE_BUSTER_ENV_VARIABLE, str(datetime.now()))
+        output = await ctr.with_exec(["sh", "-c", ENGINE_RESOURCES_SCRIPT]).stdout()
+
+        cpus, mem_total, mem_limit = output.split()
+        memory = int(mem_total) * 1024
+        if mem_limit != "max":
+            memory = min(memory, int(mem_limit))
+
+        # Bound by both CPUs and memory to neither oversubscribe nor run out of memory
+        return max(1, min(int(cpus) // share, memory // share // MEMORY_PER_THREAD))
+
+    def _cache_volume(self, key: str) -> dagger.CacheVolume:
+        # The parse cache is only valid for the bitbake version it was written by, so it is kept
+        # per scope. Sstate objects are keyed by their signatures and thus safe to share by default,
+        # as are downloads and repo refs
+        if key == CACHE_CACHE_KEY or (key == SSTATE_CACHE_KEY and self.scope_sstate):
+            scope = self.cache_scope or self.base_image_ref
+            # Hashed, as image references and branch names contain characters not meant for keys
+            key = f"{key}-{hashlib.sha256(scope.encode()).hexdigest()[:12]}"
+
+        return dag.cache_volume(key, namespace="kas")
+
+    def _cache_sharing(self, key: str) -> dagger.CacheSharingMode:
+        if key in (CACHE_CACHE_KEY, REPO_REF_CACHE_KEY) and not self.shared_caches:
+            return dagger.CacheSharingMode.PRIVATE
+
+        return dagger.CacheSharingMode.SHARED
+
+    def _with_script(
+        self,
+        ctr: dagger.Container,
+        name: str,
+        args: list[str],
+        *,
+        redirect_stdout: str = "",
+    ) -> dagger.Container:
+        path = f"{SCRIPTS_MOUNT_DIR}/{name}"
+        return ctr.with_mounted_file(path, script_file(name)).with_exec(
+            ["python3", path, *args],
+            redirect_stdout=redirect_stdout,
+        )
+
+    async def _resolve_refs(self, configs: list[str] | None) -> str:
+        if not configs:
+            raise ValueError("Expected at least one configuration file to resolve refs")
+
+        # Querying the remotes must always re-run, but only on a branch of the current container
+        ctr = self.container().with_env_variable(CACHE_BUSTER_ENV_VARIABLE, str(datetime.now()))
+
+        args = [*configs, "--work-dir", KAS_WORK_DIR]
+
+        return await self._with_script(ctr, "resolve_refs.py", args).stdout()
+
+    async def _warm_repo_refs(self, configs: list[str] | None, jobs: int) -> str:
+        if not configs:
+            raise ValueError("Expected at least one configuration file to warm repo refs")
+
+        non_root_user = await self._non_root_user(self.container())
+        # Imported by the warm-up script
+        resolve_refs_script = f"{SCRIPTS_MOUNT_DIR}/resolve_refs.py"
+
+        # Updating the mirrors must always re-run, but only on a branch of the current container.
+        # The volume is shared with concurrent warm-ups, which lock each repository
+        ctr = (
+            self.container()
+            .with_mounted_cache(
+                KAS_REPO_REF_DIR,
+                self._cache_volume(REPO_REF_CACHE_KEY),
+                sharing=dagger.CacheSharingMode.SHARED,
+                owner=non_root_user,
+            )
+            .with_mounted_file(resolve_refs_script, script_file("resolve_refs.py"))
+            .with_env_variable(CACHE_BUSTER_ENV_VARIABLE, str(datetime.now()))
+        )
+
+        args = [
+            *configs,
+            "--work-dir",
+            KAS_WORK_DIR,
+            "--ref-dir",
+            KAS_REPO_REF_DIR,
+            "--jobs",
+            str(jobs),
+        ]
+
+        return await self._with_script(ctr, "warm_repo_refs.py", args).stdout()
+
+    async def _prune_cache(
+        self,
+        key: str,
+        path: str,
+        *,
+        unit: str,
+        max_size: int | None,
+        max_age: int | None,
+        order: str,
+    ) -> "PruneReport":
+        if max_size is None and max_age is None:
+            raise ValueError("Expected at least one of max_size or max_age")
+
+        ctr = self._base()
+        non_root_user = await self._non_root_user(ctr)
+
+        # Cache volumes are not part of the cache key, thus always re-run the eviction
+        ctr = ctr.with_mounted_cache(
+            path,
+            self._cache_volume(key),
+            sharing=self._cache_sharing(key),
+            owner=non_root_user,
+        ).with_env_variable(CACHE_BUSTER_ENV_VARIABLE, str(datetime.now()))
+
+        args = [path, "--unit", unit, "--order", order]
+
+        if max_size is not None:
+            args.extend(["--max-size", str(max_size)])
+
+        if max_age is not None:
+            args.extend(["--max-age", str(max_age)])
+
+        report = json.loads(await self._with_script(ctr, "prune_cache.py", args).stdout())
+
+        return PruneReport(cache=key, **report)  # type: ignore
+
+    def _to_json(self, file: dagger.File) -> dagger.File:
+        # Converted once by the engine, so that the accessors of dump and lock results only need to
+        # read the contents
+        return (
+            self._base()
+            .with_mounted_file(CONFIG_FILEPATH, file)
+            .with_exec(
+                ["python3", "-c", YAML_TO_JSON_SCRIPT, CONFIG_FILEPATH],
+                redirect_stdout=CONFIG_JSON_FILEPATH,
+            )
+            .file(CONFIG_JSON_FILEPATH)
+        )
+
+    def _fork(self) -> Self:
+        # Shallow copy so that concurrent pipelines can diverge from the current container
+        return copy.copy(self)
+
     def _base(self) -> dagger.Container:
         return (
             dag.container()
@@ -662,13 +2046,164 @@ class Kas:
         )
 
 
+@object_type
+class KasRepo:
+    name: Annotated[str, Doc("Repository name")] = field()
+    url: Annotated[str | None, Doc("Repository URL, unset for local repositories")] = field()
+    commit: Annotated[str | None, Doc("Commit SHA")] = field()
+    branch: Annotated[str | None, Doc("Branch")] = field()
+    tag: Annotated[str | None, Doc("Tag")] = field()
+    path: Annotated[str | None, Doc("Checkout path, relative to the work directory")] = field()
+    layers: Annotated[list[str], Doc("Enabled layers, relative to the repository")] = field()
+
+
 @object_type
 class WithDumpResult:
     kas: Annotated[Kas, Doc("Kas instance")] = field()
     result: Annotated[dagger.File, Doc("Dump output file")] = field()
+    config: Annotated[dagger.File, Doc("Dump output converted to JSON")] = field()
+
+    @function
+    async def repos(self) -> list[KasRepo]:
+        return parse_repos(await self._load_config())
+
+    @function
+    async def layers(self) -> list[str]:
+        # Relative to the work directory
+        layers = []
+        for repo in await self.repos():
+            # Local repositories without a path are the one containing the configuration
+            repo_dir = repo.path or (repo.name if repo.url is not None else ".")
+            layers.extend(os.path.normpath(os.path.join(repo_dir, layer)) for layer in repo.layers)
+
+        return layers
+
+    @function
+    async def machine(self) -> str:
+        config = await self._load_config()
+        return config.get("machine") or KAS_DEFAULT_MACHINE
+
+    @function
+    async def distro(self) -> str:
+        config = await self._load_config()
+        return config.get("distro") or KAS_DEFAULT_DISTRO
+
+    @function
+    async def targets(self) -> list[str]:
+        config = await self._load_config()
+        target = config.get("target") or KAS_DEFAULT_TARGET
+        return [target] if isinstance(target, str) else target
+
+    @function
+    async def local_conf_header(self) -> str:
+        # In the order kas writes the headers to local.conf
+        config = await self._load_config()
+        headers = config.get("local_conf_header") or {}
+        return "\n".join(headers[name] for name in sorted(headers))
+
+    async def _load_config(self) -> dict:
+        return json.loads(await self.config.contents()) or {}
 
 
 @object_type
 class WithLockResult:
     kas: Annotated[Kas, Doc("Kas instance")] = field()
     result: Annotated[dagger.File, Doc("Lock file output")] = field()
+    config: Annotated[dagger.File, Doc("Lock file output converted to JSON")] = field()
+
+    @function
+    async def repos(self) -> list[KasRepo]:
+        return parse_repos(json.loads(await self.config.contents()) or {})
+
+
+@object_type
+class BuildMatrixResult:
+    config: Annotated[str, Doc("Colon-separated configuration file(s)")] = field()
+    machine: Annotated[str | None, Doc("Machine override")] = field()
+    build_dir: Annotated[dagger.Directory, Doc("Build directory")] = field()
+    exit_code: Annotated[int, Doc("Exit code of the build")] = field()
+    duration: Annotated[float, Doc("Wall time of the build in seconds")] = field()
+
+
+@object_type
+class PruneReport:
+    cache: Annotated[str, Doc("Cache volume key")] = field()
+    bytes_freed: Annotated[int, Doc("Bytes freed")] = field()
+    bytes_kept: Annotated[int, Doc("Bytes kept")] = field()
+    objects_removed: Annotated[int, Doc("Number of objects removed")] = field()
+    objects_kept: Annotated[int, Doc("Number of objects kept")] = field()
+
+
+@object_type
+class BuildReport:
+    build_dir: Annotated[dagger.Directory, Doc("Build directory")] = field()
+    report: Annotated[dagger.File, Doc("Per-recipe and per-task statistics (JSON)")] = field()
+    elapsed: Annotated[float, Doc("Wall time of all tasks in seconds")] = field()
+    cpu: Annotated[float, Doc("CPU time of all tasks in seconds")] = field()
+    critical_path: Annotated[list[str], Doc("Tasks on the critical path (recipe:task)")] = field()
+    sstate_wanted: Annotated[int, Doc("Sstate objects wanted")] = field()
+    sstate_local: Annotated[int, Doc("Sstate objects found locally")] = field()
+    sstate_mirrors: Annotated[int, Doc("Sstate objects found on mirrors")] = field()
+    sstate_missed: Annotated[int, Doc("Sstate objects missed")] = field()
+    sstate_current: Annotated[int, Doc("Sstate objects already current")] = field()
+
+
+@object_type
+class CacheVolumeStats:
+    key: Annotated[str, Doc("Cache volume key")] = field()
+    path: Annotated[str, Doc("Mount point of the cache volume")] = field()
+    size: Annotated[int, Doc("Size on disk in bytes")] = field()
+
+
+@object_type
+class CacheStats:
+    sstate_wanted: Annotated[int, Doc("Sstate objects wanted by the latest build")] = field()
+    sstate_found: Annotated[int, Doc("Sstate objects found locally or on mirrors")] = field()
+    sstate_missed: Annotated[int, Doc("Sstate objects missed")] = field()
+    sstate_hit_rate: Annotated[float, Doc("Share of wanted sstate objects found")] = field()
+    tasks_attempted: Annotated[int, Doc("Tasks attempted by the latest build")] = field()
+    tasks_reused: Annotated[int, Doc("Tasks that didn't need to be rerun")] = field()
+    downloads_fetched: Annotated[int, Doc("Downloads fetched by the latest build")] = field()
+    downloads_cached: Annotated[int, Doc("Downloads cached before the latest build")] = field()
+    volumes: Annotated[list[CacheVolumeStats], Doc("Cache volume sizes")] = field()
+
+
+@object_type
+class ShellCommandResult:
+    command: Annotated[str, Doc("Command")] = field()
+    exit_code: Annotated[int, Doc("Exit code of the command")] = field()
+    stdout: Annotated[str, Doc("Standard output of the command")] = field()
+
+
+@object_type
+class WithShellSessionResult:
+    kas: Annotated[Kas, Doc("Kas instance")] = field()
+    result: Annotated[dagger.File, Doc("Results of all commands (JSON)")] = field()
+
+    @function
+    async def results(self) -> list[ShellCommandResult]:
+        return [
+            ShellCommandResult(**result)  # type: ignore
+            for result in json.loads(await self.result.contents())
+        ]
+
+
+@object_type
+class RepoCommandResult:
+    name: Annotated[str, Doc("Repository name")] = field()
+    exit_code: Annotated[int, Doc("Exit code of the command")] = field()
+    stdout: Annotated[str, Doc("Standard output of the command")] = field()
+    duration: Annotated[float, Doc("Wall time of the command in seconds")] = field()
+
+
+@object_type
+class WithForAllReposParallelResult:
+    kas: Annotated[Kas, Doc("Kas instance")] = field()
+    result: Annotated[dagger.File, Doc("Results of the command per repository (JSON)")] = field()
+
+    @function
+    async def results(self) -> list[RepoCommandResult]:
+        return [
+            RepoCommandResult(**result)  # type: ignore
+            for result in json.loads(await self.result.contents())
+        ]
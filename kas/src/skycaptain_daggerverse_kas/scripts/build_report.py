@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# Skycaptain: Daggerverse
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Summarize the buildstats, console log and output of the latest bitbake build, and optionally the
+state of the cache directories.
+
+Runs inside the kas container and prints a JSON report to stdout.
+"""
+
+import argparse
+import calendar
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+SSTATE_SUMMARY_RE = re.compile(
+    r"Sstate summary: Wanted (?P<wanted>\d+) Local (?P<local>\d+)"
+    r"(?: Mirrors (?P<mirrors>\d+))? Missed (?P<missed>\d+) Current (?P<current>\d+)"
+)
+TASKS_SUMMARY_RE = re.compile(
+    r"Tasks Summary: Attempted (?P<attempted>\d+) tasks? of which (?P<reused>\d+) didn't need"
+)
+
+# Matches the target of console-latest.log, named after BB_CONSOLELOG, e.g. ${DATETIME}.log in OE
+CONSOLE_LOG_RE = re.compile(r"(?:console-)?(?P<datetime>\d{14})\.log$")
+
+CPU_FIELDS = (
+    "rusage ru_utime",
+    "rusage ru_stime",
+    "Child rusage ru_utime",
+    "Child rusage ru_stime",
+)
+
+
+def latest(pattern: str) -> str | None:
+    paths = sorted(glob.glob(pattern))
+    return paths[-1] if paths else None
+
+
+def console_log(build_dir: str) -> str | None:
+    return latest(os.path.join(build_dir, "tmp*", "log", "cooker", "*", "console-latest.log"))
+
+
+def disk_usage(path: str) -> int:
+    # Count allocated blocks rather than apparent sizes, and every inode only once, so sparse and
+    # hard-linked files match the actual usage of the volume
+    size = 0
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            size += st.st_blocks * 512
+    return size
+
+
+def parse_task(path: str) -> dict:
+    values = {}
+    with open(path, errors="replace") as f:
+        for line in f:
+            key, sep, value = line.partition(":")
+            if sep:
+                values[key.strip()] = value.strip()
+
+    def number(key: str) -> float:
+        try:
+            return float(values.get(key, "0").split()[0])
+        except (IndexError, ValueError):
+            return 0.0
+
+    return {
+        "started": number("Started"),
+        "ended": number("Ended"),
+        "elapsed": number("Elapsed time"),
+        "cpu": sum(number(key) for key in CPU_FIELDS),
+        "status": values.get("Status", ""),
+    }
+
+
+def parse_buildstats(build_dir: str) -> dict:
+    recipes = {}
+
+    buildstats_dir = latest(os.path.join(build_dir, "tmp*", "buildstats", "*"))
+    if buildstats_dir is None:
+        return recipes
+
+    for recipe_dir in sorted(glob.glob(os.path.join(buildstats_dir, "*", ""))):
+        tasks = {
+            os.path.basename(path): parse_task(path)
+            for path in sorted(glob.glob(os.path.join(recipe_dir, "do_*")))
+        }
+        if tasks:
+            recipes[os.path.basename(os.path.dirname(recipe_dir))] = {
+                "elapsed": sum(task["elapsed"] for task in tasks.values()),
+                "cpu": sum(task["cpu"] for task in tasks.values()),
+                "tasks": tasks,
+            }
+
+    return recipes
+
+
+def critical_path(recipes: dict) -> list[str]:
+    """
+    Approximate the critical path from timing alone: starting with the last task to finish, walk
+    back to the task that finished last before the current one started.
+    """
+    tasks = sorted(
+        (
+            (task["started"], task["ended"], f"{recipe}:{name}")
+            for recipe, stats in recipes.items()
+            for name, task in stats["tasks"].items()
+            if task["ended"]
+        ),
+        key=lambda task: task[1],
+    )
+
+    path = []
+    while tasks:
+        started, _, name = tasks.pop()
+        path.append(name)
+        tasks = [task for task in tasks if task[1] <= started]
+
+    return list(reversed(path))
+
+
+def parse_summaries(build_dir: str, build_stdout: str | None) -> dict:
+    """
+    Take the sstate summary from the console log and the tasks summary from the output of the
+    build, as knotty only prints the latter to stdout.
+    """
+    summary = {
+        "sstate": {"wanted": 0, "local": 0, "mirrors": 0, "missed": 0, "current": 0},
+        "tasks": {"attempted": 0, "reused": 0},
+    }
+
+    for path in (console_log(build_dir), build_stdout):
+        if path is None or not os.path.exists(path):
+            continue
+
+        with open(path, errors="replace") as f:
+            for line in f:
+                if match := SSTATE_SUMMARY_RE.search(line):
+                    summary["sstate"] = {k: int(v or 0) for k, v in match.groupdict().items()}
+                elif match := TASKS_SUMMARY_RE.search(line):
+                    summary["tasks"] = {k: int(v) for k, v in match.groupdict().items()}
+
+    return summary
+
+
+def parse_downloads(build_dir: str, downloads_dir: str) -> dict:
+    """
+    Split the downloads into those fetched by the latest build and those already cached before.
+    The start of the build is taken from the timestamp in the name of the latest console log.
+    """
+    summary = {"fetched": 0, "cached": 0}
+
+    log = console_log(build_dir)
+    match = CONSOLE_LOG_RE.search(os.path.realpath(log)) if log else None
+    if match is None:
+        return summary
+
+    started = calendar.timegm(time.strptime(match["datetime"], "%Y%m%d%H%M%S"))
+
+    # Each completed download is marked by a stamp file, e.g. git2/*.done for git clones
+    for stamp in glob.glob(os.path.join(downloads_dir, "**", "*.done"), recursive=True):
+        summary["fetched" if os.lstat(stamp).st_mtime >= started else "cached"] += 1
+
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("build_dir")
+    parser.add_argument("--build-stdout")
+    parser.add_argument("--downloads-dir")
+    parser.add_argument("--cache", action="append", default=[], metavar="KEY=PATH")
+    args = parser.parse_args()
+
+    recipes = parse_buildstats(args.build_dir)
+    tasks = [task for stats in recipes.values() for task in stats["tasks"].values()]
+
+    json.dump(
+        {
+            "elapsed": (
+                max(task["ended"] for task in tasks) - min(task["started"] for task in tasks)
+                if tasks
+                else 0.0
+            ),
+            "cpu": sum(task["cpu"] for task in tasks),
+            "critical_path": critical_path(recipes),
+            "recipes": recipes,
+            **parse_summaries(args.build_dir, args.build_stdout),
+            "downloads": (
+                parse_downloads(args.build_dir, args.downloads_dir) if args.downloads_dir else None
+            ),
+            "caches": {
+                key: disk_usage(path) for key, path in (cache.split("=", 1) for cache in args.cache)
+            },
+        },
+        sys.stdout,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Skycaptain: Daggerverse
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Collect the logs of the tasks that failed in the latest bitbake build, and optionally the tail of its
+console log, into a directory.
+
+Runs inside the kas container next to build_report.py. Task logs keep their path relative to the
+build directory.
+"""
+
+import argparse
+import os
+import re
+import shutil
+
+from build_report import console_log
+
+FAILURE_LOG_RE = re.compile(r"Logfile of failure stored in: (?P<path>\S+)")
+
+
+def failed_task_logs(log: str) -> list[str]:
+    with open(log, errors="replace") as f:
+        return sorted({match["path"] for line in f if (match := FAILURE_LOG_RE.search(line))})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("build_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--console-tail", type=int, default=0)
+    args = parser.parse_args()
+
+    shutil.rmtree(args.output_dir, ignore_errors=True)
+    os.makedirs(args.output_dir)
+
+    log = console_log(args.build_dir)
+    if log is None:
+        return
+
+    for path in failed_task_logs(log):
+        # Work directories may be gone, e.g. when kept on a tmpfs
+        if not os.path.exists(path):
+            continue
+
+        dest = os.path.join(args.output_dir, os.path.relpath(path, args.build_dir))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(path, dest)
+
+    if args.console_tail > 0:
+        with open(log, "rb") as f:
+            f.seek(max(os.fstat(f.fileno()).st_size - args.console_tail, 0))
+            tail = f.read()
+
+        with open(os.path.join(args.output_dir, "console-latest.log"), "wb") as f:
+            f.write(tail)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Skycaptain: Daggerverse
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Run a command in all repositories of a kas configuration concurrently.
+
+Reads the repositories from a JSON lines file with the KAS_REPO_* environment of each repository, as
+captured by kas for-all-repos. Writes a JSON list with the stdout, exit code and duration of the
+command in each repository.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run(command: str, repo: dict[str, str]) -> dict:
+    # Same environment as kas for-all-repos provides to the command
+    env = {**os.environ, **repo}
+
+    start = time.monotonic()
+    process = subprocess.run(
+        command,
+        shell=True,
+        cwd=repo["KAS_REPO_PATH"],
+        stdout=subprocess.PIPE,
+        env=env,
+    )
+
+    return {
+        "name": repo["KAS_REPO_NAME"],
+        "exit_code": process.returncode,
+        "stdout": process.stdout.decode(errors="replace"),
+        "duration": time.monotonic() - start,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("repos")
+    parser.add_argument("command")
+    parser.add_argument("output")
+    parser.add_argument("--jobs", type=int, default=8)
+    args = parser.parse_args()
+
+    with open(args.repos) as f:
+        repos = [json.loads(line) for line in f if line.strip()]
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda repo: run(args.command, repo), repos))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f)
+
+
+if __name__ == "__main__":
+    main()
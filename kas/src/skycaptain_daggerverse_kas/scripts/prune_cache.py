@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Skycaptain: Daggerverse
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Evict entries from a cache directory by age and down to a size budget.
+
+Runs inside the kas container and prints a JSON report to stdout.
+"""
+
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import stat
+import sys
+import time
+
+# Companion files that are evicted together with the object they belong to
+COMPANION_SUFFIXES = (".siginfo", ".done")
+
+# Top-level directories holding one entry per source, e.g. the clones of the git fetcher
+NESTED_ENTRY_DIRS = ("git2", "svn")
+
+
+def stat_tree(path: str, order: str) -> tuple[int, float]:
+    """
+    Return the total size and the most recent access/modification time of a path. Raises
+    FileNotFoundError if the path itself is gone, but skips entries below it that vanish while
+    walking, e.g. renamed or removed by a concurrent build.
+    """
+    st = os.lstat(path)
+    size, last = st.st_size, getattr(st, f"st_{order}")
+
+    if stat.S_ISDIR(st.st_mode):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                try:
+                    st = os.lstat(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue
+                size += st.st_size
+                last = max(last, getattr(st, f"st_{order}"))
+
+    return size, last
+
+
+def group_key(path: str) -> str:
+    for suffix in COMPANION_SUFFIXES:
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+@contextlib.contextmanager
+def object_lock(path: str):
+    """
+    Take the lock file bitbake holds while fetching or writing an object. Yields whether the object
+    may be evicted, i.e. is not in use by a concurrent build. The lock file is created if missing
+    and, once the object is gone, removed while still held, which bitbake detects after locking.
+    """
+    lock_path = f"{path}.lock"
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        yield True
+
+        if not os.path.lexists(path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(lock_path)
+    finally:
+        os.close(fd)
+
+
+def collect(root: str, unit: str) -> list[str]:
+    """
+    Collect the evictable paths: top-level entries or individual files. The entries of nested
+    entry directories are collected instead of the directories themselves.
+    """
+    if unit == "entry":
+        entries = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name in NESTED_ENTRY_DIRS and os.path.isdir(path) and not os.path.islink(path):
+                with contextlib.suppress(FileNotFoundError):
+                    entries.extend(os.path.join(path, child) for child in os.listdir(path))
+            else:
+                entries.append(path)
+        return entries
+
+    return [
+        os.path.join(dirpath, name) for dirpath, _, filenames in os.walk(root) for name in filenames
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root")
+    parser.add_argument("--unit", choices=["entry", "file"], default="file")
+    parser.add_argument("--order", choices=["atime", "mtime"], default="atime")
+    parser.add_argument("--max-size", type=int)
+    parser.add_argument("--max-age", type=int)
+    args = parser.parse_args()
+
+    # Group companion files, e.g. sstate objects and their siginfo, into a single object
+    objects: dict[str, dict] = {}
+    for path in collect(args.root, args.unit):
+        # Never evict locks that may be held by a running build
+        if path.endswith(".lock"):
+            continue
+
+        key = group_key(path)
+        try:
+            size, last = stat_tree(path, args.order)
+        except FileNotFoundError:
+            # Renamed or removed by a concurrent build
+            continue
+        obj = objects.setdefault(key, {"key": key, "paths": [], "size": 0, "last": 0.0})
+        obj["paths"].append(path)
+        obj["size"] += size
+        obj["last"] = max(obj["last"], last)
+
+    # Least recently used first
+    candidates = sorted(objects.values(), key=lambda obj: obj["last"])
+    total = sum(obj["size"] for obj in candidates)
+    now = time.time()
+
+    removed = []
+    for obj in candidates:
+        expired = args.max_age is not None and now - obj["last"] > args.max_age
+        over_budget = args.max_size is not None and total > args.max_size
+        if not (expired or over_budget):
+            continue
+
+        with object_lock(obj["key"]) as evictable:
+            # Keep objects that are being written or read by a concurrent build
+            if not evictable:
+                continue
+
+            for path in obj["paths"]:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+
+        total -= obj["size"]
+        removed.append(obj)
+
+    json.dump(
+        {
+            "bytes_freed": sum(obj["size"] for obj in removed),
+            "bytes_kept": total,
+            "objects_removed": len(removed),
+            "objects_kept": len(candidates) - len(removed),
+        },
+        sys.stdout,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Skycaptain: Daggerverse
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Resolve the refs of the repositories in a kas configuration to commit SHAs without checking them
+out, querying the remotes for floating refs only.
+
+Runs inside the kas container and prints a JSON object mapping repository names to SHAs to stdout.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+
+def lock_file(path: str) -> str:
+    # Kas automatically applies a lock file named after the configuration file
+    root, ext = os.path.splitext(path)
+    return f"{root}.lock{ext}"
+
+
+def load(path: str, work_dir: str, seen: set[str]) -> list[dict]:
+    """
+    Load a configuration file and its local includes, in the order kas merges them.
+    """
+    path = os.path.realpath(path)
+    if path in seen or not os.path.exists(path):
+        return []
+    seen.add(path)
+
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+
+    configs = []
+    for include in config.get("header", {}).get("includes", []):
+        # Includes from other repositories are covered by the SHA of that repository
+        if isinstance(include, str):
+            candidates = [
+                os.path.join(work_dir, include),
+                os.path.join(os.path.dirname(path), include),
+            ]
+            include_path = next(filter(os.path.exists, candidates), candidates[0])
+            configs.extend(load(include_path, work_dir, seen))
+
+    configs.append(config)
+    configs.extend(load(lock_file(path), work_dir, seen))
+
+    return configs
+
+
+def collect_repos(configs: list[str], work_dir: str) -> dict[str, dict]:
+    repos: dict[str, dict] = {}
+    defaults: dict = {}
+
+    seen: set[str] = set()
+    for config_path in (path for config in configs for path in config.split(":")):
+        for config in load(os.path.join(work_dir, config_path), work_dir, seen):
+            defaults.update(config.get("defaults", {}).get("repos", {}))
+            for name, repo in (config.get("repos") or {}).items():
+                repos.setdefault(name, {}).update(repo or {})
+
+    # Local repositories are part of the source directory
+    return {
+        name: {**defaults, **repo}
+        for name, repo in repos.items()
+        if repo.get("url") and repo.get("type", "git") == "git"
+    }
+
+
+def ls_remote(url: str, patterns: list[str]) -> dict[str, str]:
+    result = subprocess.run(
+        ["git", "ls-remote", url, *patterns],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return {ref: sha for sha, ref in (line.split("\t", 1) for line in result.stdout.splitlines())}
+
+
+def resolve(repo: dict) -> str:
+    # Pinned commits don't need to be queried
+    if repo.get("commit"):
+        return repo["commit"]
+
+    if tag := repo.get("tag"):
+        refs = ls_remote(repo["url"], [f"refs/tags/{tag}", f"refs/tags/{tag}^{{}}"])
+        return refs.get(f"refs/tags/{tag}^{{}}") or refs[f"refs/tags/{tag}"]
+
+    if branch := repo.get("branch") or repo.get("refspec"):
+        branch = branch.removeprefix("refs/heads/")
+        return ls_remote(repo["url"], [f"refs/heads/{branch}"])[f"refs/heads/{branch}"]
+
+    return ls_remote(repo["url"], ["HEAD"])["HEAD"]
+
+
+def setup_credentials() -> None:
+    # Let git pick up the credentials in the same way kas does
+    if netrc_file := os.environ.get("NETRC_FILE"):
+        home = tempfile.mkdtemp()
+        shutil.copy(netrc_file, os.path.join(home, ".netrc"))
+        os.environ["HOME"] = home
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", nargs="+")
+    parser.add_argument("--work-dir", default=os.getcwd())
+    parser.add_argument("--jobs", type=int, default=8)
+    args = parser.parse_args()
+
+    setup_credentials()
+
+    repos = collect_repos(args.config, args.work_dir)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        shas = dict(zip(repos, executor.map(resolve, repos.values())))
+
+    json.dump(shas, sys.stdout, sort_keys=True, separators=(",", ":"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Skycaptain: Daggerverse
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Run a batch of commands in a single kas shell session.
+
+Keeps the bitbake server memory resident between the commands, so that the metadata is only parsed
+once. Writes a JSON list with the stdout and exit code of each command.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("commands")
+    parser.add_argument("output")
+    parser.add_argument("--server-timeout", type=int, default=60)
+    args = parser.parse_args()
+
+    with open(args.commands) as f:
+        commands = json.load(f)
+
+    # Picked up by each bitbake invocation, keeping the server alive until the next one connects
+    env = {**os.environ, "BB_SERVER_TIMEOUT": str(args.server_timeout)}
+
+    results = []
+    for command in commands:
+        process = subprocess.run(command, shell=True, stdout=subprocess.PIPE, env=env)
+        results.append(
+            {
+                "command": command,
+                "exit_code": process.returncode,
+                "stdout": process.stdout.decode(errors="replace"),
+            }
+        )
+
+    # Shut down the server right away instead of waiting for the timeout to expire
+    subprocess.run(["bitbake", "--kill-server"], env=env, stdout=subprocess.DEVNULL)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f)
+
+
+if __name__ == "__main__":
+    main()
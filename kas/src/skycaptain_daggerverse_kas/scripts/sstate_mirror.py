@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Skycaptain: Daggerverse
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Serve an sstate cache directory over HTTP for use in SSTATE_MIRRORS, or push the objects of a local
+sstate cache directory to such a server.
+
+The server answers GET and HEAD requests and optionally accepts uploads by PUT, which are published
+by an atomic rename so that readers never see partial objects.
+"""
+
+import argparse
+import functools
+import http.server
+import os
+import sys
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 1 << 20
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    read_only = True
+
+    def do_PUT(self) -> None:
+        if self.read_only:
+            self.send_error(405, "Uploads are disabled")
+            return
+
+        # Drops any ".." components, so that uploads stay within the served directory
+        path = self.translate_path(self.path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        remaining = int(self.headers.get("Content-Length", 0))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        with os.fdopen(fd, "wb") as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+
+        if remaining > 0:
+            os.remove(tmp_path)
+            self.send_error(400, "Incomplete upload")
+            return
+
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def serve(args: argparse.Namespace) -> None:
+    handler = functools.partial(Handler, directory=args.root)
+    Handler.read_only = args.read_only
+
+    with http.server.ThreadingHTTPServer(("0.0.0.0", args.port), handler) as server:
+        server.serve_forever()
+
+
+def mtime(path: str) -> float | None:
+    try:
+        return os.lstat(path).st_mtime
+    except FileNotFoundError:
+        # Renamed or removed by a concurrent build
+        return None
+
+
+def collect(root: str, newer_than: float) -> list[str]:
+    # Sstate objects and their siginfo files, but no locks or temporary files
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.startswith("sstate:") or name.endswith(".lock"):
+                continue
+
+            path = os.path.join(dirpath, name)
+            if (path_mtime := mtime(path)) is not None and path_mtime >= newer_than:
+                paths.append(os.path.relpath(path, root))
+
+    return paths
+
+
+def push_object(root: str, url: str, path: str) -> bool:
+    object_url = f"{url.rstrip('/')}/{urllib.parse.quote(path)}"
+
+    try:
+        urllib.request.urlopen(urllib.request.Request(object_url, method="HEAD"))
+        return False
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+
+    try:
+        f = open(os.path.join(root, path), "rb")
+    except FileNotFoundError:
+        # Vanished since it was collected
+        return False
+
+    with f:
+        request = urllib.request.Request(
+            object_url,
+            data=f,
+            method="PUT",
+            headers={"Content-Length": str(os.fstat(f.fileno()).st_size)},
+        )
+        urllib.request.urlopen(request)
+
+    return True
+
+
+def push(args: argparse.Namespace) -> None:
+    newer_than = os.stat(args.newer_than).st_mtime if args.newer_than else 0.0
+    paths = collect(args.root, newer_than)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        pushed = sum(executor.map(lambda path: push_object(args.root, args.url, path), paths))
+
+    print(f"Pushed {pushed} of {len(paths)} sstate objects to {args.url}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("root")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--read-only", action="store_true")
+    serve_parser.set_defaults(func=serve)
+
+    push_parser = subparsers.add_parser("push")
+    push_parser.add_argument("root")
+    push_parser.add_argument("url")
+    push_parser.add_argument("--newer-than", metavar="FILE")
+    push_parser.add_argument("--jobs", type=int, default=8)
+    push_parser.set_defaults(func=push)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Skycaptain: Daggerverse
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Clone or incrementally fetch bare mirrors of the repositories in a kas configuration into the
+reference directory that kas clones from (KAS_REPO_REF_DIR).
+
+Runs inside the kas container next to resolve_refs.py and prints a JSON object mapping the mirror
+names to the action taken to stdout.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from resolve_refs import collect_repos, setup_credentials
+
+FETCH_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+
+def qualified_name(url: str) -> str:
+    # Same naming as kas uses to look up a reference repository
+    parsed = urlparse(url)
+    name = f"{parsed.netloc}{parsed.path}"
+    for char in "@:/*":
+        name = name.replace(char, ".")
+    return name
+
+
+def warm(url: str, ref_dir: str) -> str:
+    path = os.path.join(ref_dir, qualified_name(url))
+
+    # Serialize concurrent warm-ups of the same repository, e.g. from parallel pipelines sharing the
+    # cache volume, while different repositories proceed in parallel
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if os.path.exists(path):
+            # Kas creates reference repositories with a bare clone, which configures no fetch
+            # refspec, thus a plain fetch would only update FETCH_HEAD
+            subprocess.run(
+                ["git", "-C", path, "fetch", "--prune", "--quiet", url, *FETCH_REFSPECS],
+                check=True,
+            )
+            return "fetched"
+
+        # Clone next to the final path and rename it into place, so that kas never picks up a
+        # partial clone as reference
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        subprocess.run(["git", "clone", "--mirror", "--quiet", url, tmp_path], check=True)
+        os.rename(tmp_path, path)
+        return "cloned"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", nargs="+")
+    parser.add_argument("--work-dir", default=os.getcwd())
+    parser.add_argument("--ref-dir", required=True)
+    parser.add_argument("--jobs", type=int, default=8)
+    args = parser.parse_args()
+
+    setup_credentials()
+
+    # Repositories of the same URL share a single mirror
+    urls = sorted({repo["url"] for repo in collect_repos(args.config, args.work_dir).values()})
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        actions = executor.map(lambda url: warm(url, args.ref_dir), urls)
+
+    json.dump(
+        dict(zip(map(qualified_name, urls), actions)),
+        sys.stdout,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,29 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 #
+import asyncio
 import json
+import uuid
 
 import dagger
 from dagger import ReturnType, dag, field, function, object_type
 
 
+# Recipe fetching from a git repository next to it, so that the tests don't depend on a remote
+GIT_RECIPE = """
+SUMMARY = "Daggerverse Git Recipe"
+LICENSE = "CLOSED"
+
+SRC_URI = "git://${THISDIR}/repo.git;protocol=file;branch=main"
+SRCREV = "${AUTOREV}"
+PV = "1.0+git"
+
+inherit nopackages
+
+EXCLUDE_FROM_WORLD = "1"
+"""
+
+
 @object_type
 class Tests:
     prebuilt_caches_ctr: dagger.Container = field(default=dag.container)
@@ -15,11 +32,35 @@ class Tests:
     @function
     async def all(self):
         await self.test_prepare()
+        await self.test_prepare_exclude()
+        await self.test_prepare_parallelism()
         await self.test_kas()
+        await self.test_invalidate_layer_cache()
         await self.test_checkout()
+        await self.test_checkout_key_on_refs()
+        await self.test_warm_repo_refs()
         await self.test_dump()
+        await self.test_dump_accessors()
+        await self.test_fetch()
         await self.test_build()
+        await self.test_build_artifacts()
+        await self.test_build_targets()
+        await self.test_build_tmpfs()
+        await self.test_build_matrix()
+        await self.test_build_report()
+        await self.test_failed_task_logs()
+        await self.test_image_container()
+        await self.test_cache_stats()
+        await self.test_mirror()
+        await self.test_prune_sstate()
+        await self.test_cache_scope()
+        await self.test_shared_caches()
+        await self.test_sstate_mirror()
         await self.test_shell()
+        await self.test_shell_session()
+        await self.test_hash_equivalence()
+        await self.test_pr_service()
+        await self.test_for_all_repos_parallel()
 
     # Tests ----------------------------------------------------------------------------------------
 
@@ -37,6 +78,52 @@ class Tests:
         actual_user = await ctr.user()
         assert actual_user != "root", "Container should not run as root user"
 
+        # Check if git trusts any directory
+        cmd = ctr.with_exec(["sh", "-c", 'git config --file "$GITCONFIG_FILE" safe.directory'])
+        actual_safe_directory = await cmd.stdout()
+        assert actual_safe_directory == "*\n", "Git should trust any directory"
+
+        # Check if a passed non-root user skips querying the image
+        ctr = await dag.kas(non_root_user=actual_user).prepare(src)
+        actual_owner = await ctr.with_exec(["stat", "-c", "%U", "/build"]).stdout()
+        assert actual_owner == f"{actual_user}\n", "Build directory should be owned by the user"
+
+    @function
+    async def test_prepare_exclude(self):
+        src = self.get_src().with_new_file("build/stale", "").with_new_file("README.md", "")
+        ctr = await dag.kas().prepare(src, exclude=["build", "*.md"])
+
+        # Check if excluded content is not mounted
+        actual_entries = await ctr.directory("/workdir").entries()
+        assert "build/" not in actual_entries, "Excluded directory should not be mounted"
+        assert "README.md" not in actual_entries, "Excluded file should not be mounted"
+        assert "test_poky.yml" in actual_entries, "Configuration should be mounted"
+
+    @function
+    async def test_prepare_parallelism(self):
+        src = self.get_src()
+        kas = (
+            dag.kas()
+            .with_source(src)
+            .with_prepare(engine_share=2, parallel_make=1, pressure_max_cpu=500)
+        )
+        ctr = kas.container()
+
+        # Check if thread counts are derived from the engine unless set explicitly
+        actual_bb_number_threads = await ctr.env_variable("BB_NUMBER_THREADS")
+        assert actual_bb_number_threads is not None, "BB_NUMBER_THREADS should be set"
+        assert int(actual_bb_number_threads) >= 1, "BB_NUMBER_THREADS should be positive"
+
+        actual_parallel_make = await ctr.env_variable("PARALLEL_MAKE")
+        assert actual_parallel_make == "-j 1", "PARALLEL_MAKE should not be overridden"
+
+        # Check if bitbake picks up the pressure limits
+        ctr = kas.with_shell(
+            config=["test_poky.yml"], command="bitbake-getvar --value BB_PRESSURE_MAX_CPU"
+        ).container()
+        actual_pressure_max_cpu = await ctr.stdout()
+        assert "500" in actual_pressure_max_cpu, "BB_PRESSURE_MAX_CPU should be set"
+
     @function
     async def test_kas(self):
         src = self.get_src()
@@ -45,6 +132,21 @@ class Tests:
         # Check if result is not empty
         assert result != "", "kas command returned empty result"
 
+    @function
+    async def test_invalidate_layer_cache(self):
+        async def cache_buster(**kwargs) -> str | None:
+            ctr = dag.kas().with_invalidate_layer_cache(**kwargs).container()
+            return await ctr.env_variable("DAGGERVERSE_KAS_CACHE_BUSTER")
+
+        # Check if the same key results in the same buster
+        actual_first = await cache_buster(key="nightly", ttl=86400)
+        actual_second = await cache_buster(key="nightly", ttl=86400)
+        assert actual_first == actual_second, "Same key should not invalidate the cache"
+
+        # Check if a different key results in a different buster
+        actual_other = await cache_buster(key="release", ttl=86400)
+        assert actual_first != actual_other, "Different key should invalidate the cache"
+
     @function
     async def test_checkout(self):
         src = self.get_src()
@@ -56,6 +158,28 @@ class Tests:
         assert "poky/" in actual_entries, "Result should contain 'poky' directory"
         assert "test_poky.yml" in actual_entries, "Result should contain 'test_poky.yml' file"
 
+    @function
+    async def test_checkout_key_on_refs(self):
+        src = self.get_src()
+        source_dir = await dag.kas().checkout(src, config=["test_poky.yml"], key_on_refs=True)
+
+        # Check if the checkout is the same as without resolving refs first
+        actual_entries = await source_dir.entries()
+        assert "poky/" in actual_entries, "Result should contain 'poky' directory"
+
+    @function
+    async def test_warm_repo_refs(self):
+        src = self.get_src()
+        result = await dag.kas().warm_repo_refs(src, config=["test_poky.yml"])
+
+        # Check if the mirror is created or updated, and only fetched once it exists
+        actual_actions = json.loads(result)
+        assert "git.yoctoproject.org.poky.git" in actual_actions, "Poky should be mirrored"
+
+        result = await dag.kas().warm_repo_refs(src, config=["test_poky.yml"])
+        actual_action = json.loads(result)["git.yoctoproject.org.poky.git"]
+        assert actual_action == "fetched", "Poky should be fetched on subsequent runs"
+
     @function
     async def test_dump(self):
         src = self.get_src()
@@ -72,6 +196,48 @@ class Tests:
         except json.JSONDecodeError:
             assert False, "kas dump command returned invalid JSON"
 
+    @function
+    async def test_dump_accessors(self):
+        src = self.get_src()
+        result = dag.kas().with_source(src).with_prepare().with_dump(config=["test_poky.yml"])
+
+        # Check if the configuration is available without parsing the dump
+        actual_machine = await result.machine()
+        assert actual_machine == "qemux86-64", "Machine should be read from the configuration"
+
+        actual_targets = await result.targets()
+        assert actual_targets == ["test-daggerverse-minimal"], "Target should be a list"
+
+        actual_layers = await result.layers()
+        assert "poky/meta-poky" in actual_layers, "Layers should be relative to the work directory"
+
+        actual_repos = {await repo.name(): repo for repo in await result.repos()}
+        actual_commit = await actual_repos["poky"].commit()
+        assert actual_commit == "ac257900c33754957b2696529682029d997a8f28", "Commit should be set"
+
+    @function
+    async def test_fetch(self):
+        # A commit unique to this run, as the downloads volume is shared with earlier tests and runs
+        src = self.get_git_src(message=uuid.uuid4().hex)
+        ctr = await dag.kas().fetch(src, config=["test_poky.yml"], target="test-daggerverse-git")
+
+        # Check if the downloads cache contains the commit only this fetch could have cloned
+        cmd = await ctr.with_directory(
+            "/tmp/repo.git", src.directory("recipes-daggerverse/test-daggerverse-git/repo.git")
+        ).with_exec(
+            [
+                "sh",
+                "-c",
+                "rev=$(git --git-dir=/tmp/repo.git rev-parse main)"
+                " && for clone in /downloads/git2/*/; do"
+                ' git --git-dir="$clone" cat-file -e "$rev^{commit}" 2>/dev/null && exit 0;'
+                " done; exit 1",
+            ],
+            expect=ReturnType.ANY,
+        )
+        actual_exit_code = await cmd.exit_code()
+        assert actual_exit_code == 0, "Downloads should contain the commit fetched by this run"
+
     @function
     async def test_build(self):
         src = self.get_src()
@@ -81,6 +247,294 @@ class Tests:
 
         assert "tmp/" in entries, "Build directory should contain 'tmp' directory"
 
+    @function
+    async def test_build_artifacts(self):
+        src = self.get_src()
+        artifacts = dag.kas().build_artifacts(src, config=["test_poky.yml"])
+
+        entries = await artifacts.directory("tmp").entries()
+        assert entries == ["deploy/"], "Artifacts should only contain 'tmp/deploy' directory"
+
+        # The fixture deploys no images, but the licenses of the built recipes
+        entries = await artifacts.directory("tmp/deploy").entries()
+        assert "licenses/" in entries, "Artifacts should contain 'tmp/deploy/licenses' directory"
+
+    @function
+    async def test_build_targets(self):
+        src = self.get_src()
+        build_dir = dag.kas().build(
+            src,
+            config=["test_poky.yml"],
+            targets=["test-daggerverse-minimal", "test-daggerverse-minimal:do_listtasks"],
+        )
+
+        entries = await build_dir.entries()
+        assert "tmp/" in entries, "Build directory should contain 'tmp' directory"
+
+    @function
+    async def test_build_tmpfs(self):
+        src = self.get_src()
+        kas = (
+            dag.kas()
+            .with_source(src)
+            .with_prepare()
+            .with_build(
+                config=["test_poky.yml"],
+                target="test-daggerverse-minimal",
+                tmpfs_size=8 << 30,
+            )
+        )
+
+        # Check if the stamps of the dropped work directories are dropped as well
+        ctr = kas.container().with_exec(
+            ["find", "/build/tmp/stamps", "-path", "*/test-daggerverse-minimal/*"]
+        )
+        actual_result = await ctr.stdout()
+        assert actual_result == "", "Build directory should not keep stamps of dropped work"
+
+        # Check if later builds in the chain re-run the dropped tasks with rm_work
+        ctr = (
+            kas.with_build(
+                config=["test_poky.yml"], target="test-daggerverse-minimal", rm_work=True
+            )
+            .container()
+            .with_exec(["find", "/build/tmp/stamps", "-name", "*.do_rm_work.*"])
+        )
+        actual_result = await ctr.stdout()
+        assert actual_result != "", "Build should run rm_work"
+
+    @function
+    async def test_build_matrix(self):
+        src = self.get_src()
+        results = await dag.kas().build_matrix(
+            src, config_set=["test_poky.yml"], machine=["qemux86-64"], key_on_refs=True
+        )
+
+        assert len(results) == 1, "Build matrix should return one result per entry"
+
+        actual_exit_code = await results[0].exit_code()
+        assert actual_exit_code == 0, "Build matrix entry should succeed"
+
+        actual_machine = await results[0].machine()
+        assert actual_machine == "qemux86-64", "Build matrix entry should report its machine"
+
+        entries = await results[0].build_dir().entries()
+        assert "tmp/" in entries, "Build directory should contain 'tmp' directory"
+
+    @function
+    async def test_build_report(self):
+        src = self.get_src()
+        report = (
+            dag.kas()
+            .with_source(src)
+            .with_prepare()
+            .with_build(config=["test_poky.yml"], task="build", buildstats=True)
+            .build_report()
+        )
+
+        actual_contents = await report.report().contents()
+        try:
+            json.loads(actual_contents)
+        except json.JSONDecodeError:
+            assert False, "Build report should be valid JSON"
+
+        actual_critical_path = await report.critical_path()
+        assert len(actual_critical_path) > 0, "Critical path should not be empty"
+
+    @function
+    async def test_failed_task_logs(self):
+        src = self.get_src()
+        logs = (
+            dag.kas()
+            .with_source(src)
+            .with_prepare()
+            .with_build(
+                config=["test_poky.yml"],
+                target="test-daggerverse-failing",
+                task="fail",
+                expect=ReturnType.ANY,
+            )
+            .failed_task_logs(console_tail=4096)
+        )
+
+        # Check if only the log of the failed task and the console tail are collected
+        actual_logs = await logs.glob("**/log.do_fail.*")
+        assert len(actual_logs) == 1, "Logs should contain the log of the failed task"
+
+        actual_contents = await logs.file(actual_logs[0]).contents()
+        assert "Failing on purpose" in actual_contents, "Log should contain the error"
+
+        actual_entries = await logs.entries()
+        assert "console-latest.log" in actual_entries, "Logs should contain the console tail"
+
+    @function
+    async def test_image_container(self):
+        # Stand in for a build directory with a tiny rootfs tarball of an image
+        images = (
+            dag.kas()
+            .container()
+            .with_exec(
+                [
+                    "sh",
+                    "-c",
+                    "mkdir -p /tmp/rootfs/etc /tmp/images"
+                    " && echo test-daggerverse > /tmp/rootfs/etc/test-daggerverse"
+                    " && tar -C /tmp/rootfs -czf"
+                    " /tmp/images/test-daggerverse-image-qemux86-64.rootfs.tar.gz .",
+                ]
+            )
+            .directory("/tmp/images")
+        )
+        build_dir = dag.directory().with_directory("tmp/deploy/images/qemux86-64", images)
+        kas = dag.kas().with_container(
+            dag.kas().container().with_mounted_directory("/build", build_dir)
+        )
+
+        # Check if the container runs on the extracted rootfs
+        ctr = kas.image_container(image="test-daggerverse-image", machine="qemux86-64")
+        actual_contents = await ctr.file("/etc/test-daggerverse").contents()
+        assert actual_contents == "test-daggerverse\n", "Rootfs should contain the image's files"
+
+        # Check if a missing image is reported
+        try:
+            await kas.image_container(image="test-daggerverse-missing", machine="qemux86-64").sync()
+        except dagger.QueryError as e:
+            assert "Expected a rootfs tarball" in str(e), "Missing image should be reported"
+        else:
+            assert False, "Missing image should raise an error"
+
+    @function
+    async def test_cache_stats(self):
+        src = self.get_src()
+        stats = (
+            dag.kas()
+            .with_source(src)
+            .with_prepare()
+            .with_build(config=["test_poky.yml"], task="build")
+            .cache_stats()
+        )
+
+        # Previous tests have already built the same configuration
+        actual_sstate_wanted = await stats.sstate_wanted()
+        actual_sstate_missed = await stats.sstate_missed()
+        assert actual_sstate_missed <= actual_sstate_wanted, "Missed exceeds wanted objects"
+
+        # Check if the tasks summary and the downloads of the build are picked up
+        actual_tasks_attempted = await stats.tasks_attempted()
+        assert actual_tasks_attempted > 0, "Tasks summary should report attempted tasks"
+
+        actual_downloads = await stats.downloads_fetched() + await stats.downloads_cached()
+        assert actual_downloads > 0, "Downloads should be reported as fetched or cached"
+
+        actual_volumes = await stats.volumes()
+        assert len(actual_volumes) == 4, "Cache stats should report all cache volumes"
+
+    @function
+    async def test_mirror(self):
+        src = self.get_git_src()
+        kas = (
+            dag.kas()
+            .with_source(src)
+            .with_prepare(generate_mirror_tarballs=True)
+            .with_build(config=["test_poky.yml"], target="test-daggerverse-git", task="fetch")
+        )
+
+        # Check if bitbake generates mirror tarballs of git sources
+        ctr = kas.container()
+        actual_result = await ctr.with_exec(
+            ["find", "/downloads", "-name", "git2_*.tar.gz"]
+        ).stdout()
+        assert actual_result != "", "Downloads should contain git mirror tarballs"
+
+        mirror = kas.export_mirror()
+
+        # Check if the mirror has the expected layout
+        actual_entries = await mirror.entries()
+        assert "downloads/" in actual_entries, "Mirror should contain 'downloads' directory"
+        assert "sstate-cache/" in actual_entries, "Mirror should contain 'sstate-cache' directory"
+
+        actual_tarballs = await mirror.glob("downloads/git2_*.tar.gz")
+        assert len(actual_tarballs) > 0, "Mirror should contain git mirror tarballs"
+
+        # Check if a fresh container picks up the mirror
+        ctr = await dag.kas().with_mirror(mirror).prepare(src)
+        actual_sstate_mirrors = await ctr.env_variable("SSTATE_MIRRORS")
+        assert actual_sstate_mirrors is not None, "SSTATE_MIRRORS should be set"
+        assert "file:///mirror/sstate-cache/PATH" in actual_sstate_mirrors, (
+            "SSTATE_MIRRORS should point to the mirror"
+        )
+
+    @function
+    async def test_prune_sstate(self):
+        # Use a budget large enough to not evict anything needed by other tests
+        report = dag.kas().prune_sstate(max_size=1 << 40)
+
+        actual_bytes_freed = await report.bytes_freed()
+        assert actual_bytes_freed == 0, "Nothing should be evicted within the budget"
+
+        actual_objects_kept = await report.objects_kept()
+        assert actual_objects_kept > 0, "Sstate objects of previous builds should be kept"
+
+    @function
+    async def test_cache_scope(self):
+        src = self.get_src()
+
+        # Write a marker into the parse cache of one scope
+        await (
+            dag.kas()
+            .with_cache_scope("test-cache-scope-a")
+            .with_source(src)
+            .with_prepare()
+            .container()
+            .with_exec(["touch", "/build/cache/test-cache-scope-a"])
+            .sync()
+        )
+
+        # Check if the marker is only visible within the same scope
+        kas = dag.kas().with_cache_scope("test-cache-scope-b").with_source(src).with_prepare()
+        actual_entries = await kas.container().with_exec(["ls", "/build/cache"]).stdout()
+        assert "test-cache-scope-a" not in actual_entries, "Scopes should not share the parse cache"
+
+        kas = dag.kas().with_cache_scope("test-cache-scope-a").with_source(src).with_prepare()
+        actual_entries = await kas.container().with_exec(["ls", "/build/cache"]).stdout()
+        assert "test-cache-scope-a" in actual_entries, "Scope should keep its parse cache"
+
+    @function
+    async def test_shared_caches(self):
+        src = self.get_src()
+
+        # Check if concurrent builds succeed on the same cache volumes
+        build_dirs = await asyncio.gather(
+            *(
+                dag.kas()
+                .with_shared_caches()
+                .build(src, config=["test_poky.yml"], extra_env_variables=[f"TEST_BUILD={i}"])
+                .entries()
+                for i in range(2)
+            )
+        )
+        for entries in build_dirs:
+            assert "tmp/" in entries, "Build directory should contain 'tmp' directory"
+
+    @function
+    async def test_sstate_mirror(self):
+        src = self.get_src()
+
+        # Stand in for the sstate cache of another engine with a separately scoped volume
+        mirror = dag.kas().with_cache_scope("test-sstate-mirror", sstate=True)
+        service = mirror.sstate_mirror_service(accept_uploads=True)
+
+        build_dir = (
+            dag.kas().with_sstate_mirror(service, upload=True).build(src, config=["test_poky.yml"])
+        )
+        entries = await build_dir.entries()
+        assert "tmp/" in entries, "Build directory should contain 'tmp' directory"
+
+        # Check if the objects of the build have been uploaded to the mirror
+        ctr = mirror.with_source(src).with_prepare().container()
+        actual_result = await ctr.with_exec(["find", "/sstate-cache", "-name", "sstate:*"]).stdout()
+        assert actual_result != "", "Sstate objects should be uploaded to the mirror"
+
     @function
     async def test_shell(self):
         src = self.get_src()
@@ -90,8 +544,109 @@ class Tests:
         actual_result = await ctr.stdout()
         assert actual_result != "", "Command returned empty result"
 
+    @function
+    async def test_shell_session(self):
+        src = self.get_src()
+        results = await dag.kas().shell_session(
+            src,
+            config=["test_poky.yml"],
+            commands=["bitbake -e | grep '^MACHINE='", "false"],
+        )
+
+        # Check if each command reports its own result
+        assert len(results) == 2, "Session should return one result per command"
+
+        actual_stdout = await results[0].stdout()
+        assert 'MACHINE="qemux86-64"' in actual_stdout, "First command should print MACHINE"
+
+        actual_exit_code = await results[1].exit_code()
+        assert actual_exit_code == 1, "Second command should fail"
+
+    @function
+    async def test_hash_equivalence(self):
+        src = self.get_src()
+        kas = (
+            dag.kas()
+            .with_source(src)
+            .with_prepare(hashserv_config=["test_poky.yml"])
+            .with_shell(config=["test_poky.yml"], command="bitbake-getvar --value BB_HASHSERVE")
+        )
+
+        # Check if bitbake picks up the bound hash equivalence server
+        actual_stdout = await kas.container().stdout()
+        assert "hashserv:8686" in actual_stdout, "BB_HASHSERVE should point to the service"
+
+        # Check if the overlay configuration doesn't leak into the work directory
+        actual_entries = await kas.source().entries()
+        assert ".daggerverse-kas-overlay.yml" not in actual_entries, "Overlay should be removed"
+
+    @function
+    async def test_pr_service(self):
+        src = self.get_src()
+        ctr = (
+            dag.kas()
+            .with_source(src)
+            .with_prepare(prserv_config=["test_poky.yml"])
+            .with_shell(config=["test_poky.yml"], command="bitbake-getvar --value PRSERV_HOST")
+            .container()
+        )
+
+        # Check if bitbake picks up the bound PR server
+        actual_stdout = await ctr.stdout()
+        assert "prserv:8585" in actual_stdout, "PRSERV_HOST should point to the service"
+
+    @function
+    async def test_for_all_repos_parallel(self):
+        src = self.get_src()
+        results = await dag.kas().for_all_repos_parallel(
+            src,
+            config=["test_poky.yml"],
+            command="git rev-parse HEAD",
+        )
+
+        # Check if each repository reports its own result
+        actual_results = {await result.name(): result for result in results}
+        assert "poky" in actual_results, "Results should contain the 'poky' repository"
+
+        actual_exit_code = await actual_results["poky"].exit_code()
+        assert actual_exit_code == 0, "Command should succeed in the 'poky' repository"
+
+        actual_stdout = await actual_results["poky"].stdout()
+        expected_stdout = "ac257900c33754957b2696529682029d997a8f28\n"
+        assert actual_stdout == expected_stdout, "Command should run in the 'poky' repository"
+
     # Internal -------------------------------------------------------------------------------------
 
+    def get_git_src(self, message: str = "init") -> dagger.Directory:
+        """
+        Get the source directory for the tests with a recipe fetching from a local git repository,
+        whose single commit has the given message.
+        """
+        repo = (
+            dag.kas()
+            .container()
+            .with_exec(
+                [
+                    "sh",
+                    "-c",
+                    "git init -q -b main /tmp/repo"
+                    " && git -C /tmp/repo -c user.name=test -c user.email=test@example.com"
+                    f" commit -q --allow-empty -m {message}"
+                    " && git clone -q --bare /tmp/repo /tmp/repo.git",
+                ]
+            )
+            .directory("/tmp/repo.git")
+        )
+
+        return (
+            self.get_src()
+            .with_directory("recipes-daggerverse/test-daggerverse-git/repo.git", repo)
+            .with_new_file(
+                "recipes-daggerverse/test-daggerverse-git/test-daggerverse-git_1.0.bb",
+                GIT_RECIPE,
+            )
+        )
+
     def get_src(self) -> dagger.Directory:
         """
         Get the source directory for the tests.